@@ -1,9 +1,21 @@
+import argparse
+import hashlib
+import json
 import logging
-from urllib.parse import unquote, urljoin
+import os
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from urllib.parse import unquote, urljoin, urlparse
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
-from typing import List
+from typing import Dict, List, Tuple
 
 # Configure logging
 logging.basicConfig(
@@ -11,12 +23,158 @@ logging.basicConfig(
 )
 
 BASE_URL = "https://www.mokuro.moe/manga/"
+OUTPUT_DIR = Path("mokuro")
+MANIFEST_PATH = OUTPUT_DIR / "manifest.jsonl"
+CHANGES_PATH = OUTPUT_DIR / "changes.jsonl"
+MAX_WORKERS = 16
+CHUNK_SIZE = 64 * 1024
+PER_HOST_LIMIT = 8
+
+_host_limits: Dict[str, threading.BoundedSemaphore] = {}
+_host_limits_lock = threading.Lock()
+_per_host_limit = PER_HOST_LIMIT
+
+
+@dataclass(frozen=True)
+class VolumeFile:
+    url: str
+    manga_name: str
+    path: Path
+
+
+class Manifest:
+    """
+    Append-only record of the files that were downloaded successfully.
+    Each line is a JSON object keyed by the file URL; the last line for a URL wins,
+    so an interrupted crawl can pick up where it stopped.
+    """
+
+    def __init__(self, path: Path = MANIFEST_PATH):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if path.exists():
+            with path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-write can leave a truncated last line behind
+                        logging.warning(f"Ignoring corrupt manifest line in {path}")
+                        continue
+                    self.entries[entry["url"]] = entry
+
+    def is_complete(self, volume: VolumeFile, verify: bool = False) -> bool:
+        """
+        A volume is complete if it was recorded and the file on disk still has the
+        recorded size. With verify, the file's checksum is compared as well.
+        """
+        entry = self.entries.get(volume.url)
+        if entry is None:
+            return False
+        try:
+            size = volume.path.stat().st_size
+        except FileNotFoundError:
+            return False
+        if entry.get("size") is not None and size != entry["size"]:
+            logging.warning(f"Size mismatch, will re-fetch: {volume.path}")
+            return False
+        if verify and entry.get("sha256") != file_sha256(volume.path):
+            logging.warning(f"Checksum mismatch, will re-fetch: {volume.path}")
+            return False
+        return True
+
+    def conditional_headers(self, volume: VolumeFile) -> Dict[str, str]:
+        """Build the validators to revalidate a previously downloaded volume."""
+        entry = self.entries[volume.url]
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def record(self, volume: VolumeFile, **fields) -> None:
+        entry = {"url": volume.url, "path": str(volume.path), **fields}
+        with self._lock:
+            self.entries[volume.url] = entry
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def file_sha256(path: Path) -> str:
+    """Compute the SHA-256 of a file without loading it all in memory."""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stream_to_file(response: requests.Response, path: Path) -> Tuple[int, str]:
+    """
+    Stream a response body to a temporary file next to path and atomically move
+    it into place, so a crash never leaves a half-written volume behind.
+    Returns the size and SHA-256 of the body.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_name = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".part"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+    return size, digest.hexdigest()
+
+
+def create_session(pool_size: int = PER_HOST_LIMIT) -> requests.Session:
+    """Create a session whose connection pool is sized for the number of workers."""
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4, pool_maxsize=pool_size, max_retries=retries
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def host_limit(url: str) -> threading.BoundedSemaphore:
+    """Return the semaphore that bounds the number of in-flight requests to a host."""
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(_per_host_limit)
+        return _host_limits[host]
 
 
 def get_soup(url, session, timeout=10) -> BeautifulSoup:
     """Fetch a URL and return a BeautifulSoup object, or None if there was an error."""
     try:
-        response = session.get(url, timeout=timeout)
+        with host_limit(url):
+            response = session.get(url, timeout=timeout)
         response.raise_for_status()
     except requests.RequestException as e:
         logging.error(f"Error fetching {url}: {e}")
@@ -34,52 +192,158 @@ def get_high_level_links(soup: BeautifulSoup) -> List[str]:
     return links
 
 
-def download_mokuro_files(
+def find_volume_files(
     manga_url: str, manga_name: str, session: requests.Session
-) -> None:
+) -> List[VolumeFile]:
     """
-    Given a manga URL and its name, find and download all .mokuro files.
-    The downloaded files are stored under mokuro/<manga_name>/.
+    Given a manga URL and its name, list all the .mokuro files in its directory.
+    The files are meant to be stored under mokuro/<manga_name>/.
     """
     full_url = urljoin(BASE_URL, manga_url)
     logging.info(f"Processing manga: {manga_name} ({full_url})")
 
     soup = get_soup(full_url, session)
     if soup is None:
-        return
+        return []
 
+    volumes = []
     for anchor in soup.find_all("a", href=True):
         href = anchor["href"]
         if href.lower().endswith(".mokuro"):
             volume_name = anchor.get_text(strip=True) or Path(href).stem
-            logging.info(f"Downloading volume: {volume_name}")
-
-            file_url = urljoin(full_url, href)
-            try:
-                file_response = session.get(file_url, timeout=10)
-                file_response.raise_for_status()
-            except requests.RequestException as e:
-                logging.error(f"Failed to download {file_url}: {e}")
-                continue
-
-            output_dir = Path("mokuro") / manga_name
-            output_dir.mkdir(parents=True, exist_ok=True)
-
             # Ensure a proper filename with .mokuro extension
             volume_filename = (
                 volume_name
                 if volume_name.lower().endswith(".mokuro")
                 else f"{volume_name}.mokuro"
             )
-            output_path = output_dir / volume_filename
+            volumes.append(
+                VolumeFile(
+                    url=urljoin(full_url, href),
+                    manga_name=manga_name,
+                    path=OUTPUT_DIR / manga_name / volume_filename,
+                )
+            )
+    return volumes
 
-            with output_path.open("wb") as f:
-                f.write(file_response.content)
-            logging.info(f"Saved file to {output_path}")
+
+def download_volume(
+    volume: VolumeFile,
+    session: requests.Session,
+    manifest: Manifest,
+    revalidate: bool = False,
+) -> str:
+    """
+    Download a single .mokuro file and record it in the manifest.
+    With revalidate, the validators stored in the manifest are sent along so an
+    unchanged volume costs a 304. Returns one of "new", "changed", "unchanged"
+    or "failed".
+    """
+    previous = manifest.entries.get(volume.url)
+    headers = manifest.conditional_headers(volume) if revalidate else {}
+    logging.info(f"Downloading volume: {volume.path.name}")
+    try:
+        with host_limit(volume.url):
+            with session.get(
+                volume.url, headers=headers, timeout=10, stream=True
+            ) as file_response:
+                file_response.raise_for_status()
+                if file_response.status_code == 304:
+                    logging.info(f"Volume is unchanged: {volume.path}")
+                    return "unchanged"
+                size, sha256 = stream_to_file(file_response, volume.path)
+    except (requests.RequestException, OSError) as e:
+        logging.error(f"Failed to download {volume.url}: {e}")
+        return "failed"
+
+    manifest.record(
+        volume,
+        size=size,
+        sha256=sha256,
+        etag=file_response.headers.get("ETag"),
+        last_modified=file_response.headers.get("Last-Modified"),
+    )
+    logging.info(f"Saved file to {volume.path}")
+    if previous is None:
+        return "new"
+    # Servers without validators answer 200 even when nothing changed
+    return "unchanged" if previous.get("sha256") == sha256 else "changed"
+
+
+def download_mokuro_files(
+    manga_url: str,
+    manga_name: str,
+    session: requests.Session,
+    manifest: Manifest,
+    executor: ThreadPoolExecutor,
+    sync: bool = False,
+    verify: bool = False,
+) -> List[Tuple[VolumeFile, Future]]:
+    """
+    Find the .mokuro files of a manga and schedule the ones that aren't in the
+    manifest yet. With sync, volumes in the manifest are scheduled as well so
+    they get revalidated against the server. Volumes that are truncated, or
+    corrupted when verify is set, are fetched again in full.
+    Returns the scheduled volumes along with their download futures.
+    """
+    scheduled = []
+    for volume in find_volume_files(manga_url, manga_name, session):
+        complete = manifest.is_complete(volume, verify)
+        if complete and not sync:
+            logging.debug(f"Skipping already downloaded volume: {volume.path}")
+            continue
+        future = executor.submit(download_volume, volume, session, manifest, complete)
+        scheduled.append((volume, future))
+    return scheduled
+
+
+def save_changes(changes: List[dict], file_path: Path = CHANGES_PATH) -> None:
+    """
+    Append the volumes that were added or modified during this run to the change
+    log, each record tagged with the run, the UTC time it ended at. The log
+    keeps the delta of every run, so none is lost when several runs happen
+    between two loads.
+    """
+    run = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with file_path.open("a", encoding="utf-8") as f:
+        for change in changes:
+            f.write(json.dumps({"run": run, **change}, ensure_ascii=False) + "\n")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Download .mokuro files.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="Number of concurrent download threads",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=PER_HOST_LIMIT,
+        help="Maximum number of in-flight requests per host",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Revalidate downloaded volumes with conditional requests",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Checksum downloaded volumes and re-fetch the corrupted ones",
+    )
+    return parser.parse_args()
 
 
 def main() -> None:
-    session = requests.Session()
+    global _per_host_limit
+    args = parse_args()
+    _per_host_limit = args.per_host
+    session = create_session(pool_size=args.per_host)
+    manifest = Manifest()
 
     # Get the home page and extract the manga directories
     soup = get_soup(BASE_URL, session)
@@ -88,10 +352,48 @@ def main() -> None:
         return
 
     manga_links = get_high_level_links(soup)
-    for manga_url in manga_links:
-        # The manga name is the decoded URL without its trailing slash.
-        manga_name = unquote(manga_url.rstrip("/"))
-        download_mokuro_files(manga_url, manga_name, session)
+    # Directory listings and file downloads share the same pool, so the
+    # per-host limit bounds the total load on the server.
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        listings = [
+            executor.submit(
+                download_mokuro_files,
+                manga_url,
+                # The manga name is the decoded URL without its trailing slash.
+                unquote(manga_url.rstrip("/")),
+                session,
+                manifest,
+                executor,
+                args.sync,
+                args.verify,
+            )
+            for manga_url in manga_links
+        ]
+        scheduled = []
+        for listing in as_completed(listings):
+            scheduled.extend(listing.result())
+        statuses = Counter()
+        changes = []
+        for volume, future in scheduled:
+            status = future.result()
+            statuses[status] += 1
+            if status in ("new", "changed"):
+                changes.append(
+                    {
+                        "manga": volume.manga_name,
+                        "path": str(volume.path),
+                        "status": status,
+                    }
+                )
+
+    save_changes(changes)
+    for manga_name in sorted({change["manga"] for change in changes}):
+        logging.info(f"New or changed volumes for: {manga_name}")
+    logging.info(
+        f"{statuses['new']} new, {statuses['changed']} changed, "
+        f"{statuses['unchanged']} unchanged, {statuses['failed']} failed volumes; "
+        f"{len(manifest.entries)} volumes in the manifest"
+    )
 
 
 if __name__ == "__main__":
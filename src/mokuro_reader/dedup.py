@@ -0,0 +1,322 @@
+import argparse
+import logging
+import sqlite3
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import stats
+from schema import create_tables
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+# Volumes are compared on the sets of their SHINGLE-character substrings. The
+# MinHash signature of a volume has NUM_PERM values, split into BANDS bands of
+# ROWS values: two volumes are compared when they share a whole band, which
+# happens with probability 1 - (1 - s^ROWS)^BANDS for a similarity s, so for
+# most pairs above (1 / BANDS)^(1 / ROWS), about 0.42.
+SHINGLE = 5
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+# Estimated Jaccard similarity from which two volumes are the same volume
+THRESHOLD = 0.7
+# The hash functions are drawn from this seed, the cached signatures are only
+# valid for it
+SEED = 1
+CHUNK = 8192
+DUPLICATES_PATH = "data/duplicate_volumes.csv"
+
+# Multiply-add-shift hashing, an odd multiplier per hash function
+rng = np.random.default_rng(SEED)
+MULTIPLIERS = rng.integers(0, 2**64 - 1, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+INCREMENTS = rng.integers(0, 2**64 - 1, NUM_PERM, dtype=np.uint64)
+# The base of the polynomial hash of the shingles
+BASE = np.uint64(0x100000001B3)
+
+VOLUMES_QUERY = """select v.id, v.title_uuid, v.volume_number, v.volume, v.content_hash,
+        count(*) over (partition by v.title_uuid) as title_volume_count
+    from Volumes v
+    where v.content_hash is not null
+    order by v.id"""
+
+
+def shingles(texts: Sequence[str]) -> np.ndarray:
+    """
+    The distinct hashes of the SHINGLE-character substrings of a volume. Spaces,
+    line breaks and punctuation are dropped first: the OCR of another scan may
+    split the lines of a block differently, which changes where they're joined.
+    """
+    code_points, _ = stats.encode(texts)
+    categories = stats.categorize(code_points)
+    code_points = code_points[
+        (categories != stats.SEPARATOR) & (categories != stats.PUNCTUATION)
+    ]
+    count = len(code_points) - SHINGLE + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    code_points = code_points.astype(np.uint64)
+    # Polynomial rolling hash, computed for every window at once; the products
+    # wrap around modulo 2^64
+    hashes = np.zeros(count, dtype=np.uint64)
+    for offset in range(SHINGLE):
+        hashes = hashes * BASE + code_points[offset : offset + count]
+    return np.unique(hashes)
+
+
+def minhash(hashes: np.ndarray) -> np.ndarray:
+    """The MinHash signature of a set of shingle hashes, NUM_PERM 32-bit values."""
+    signature = np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint64)
+    for start in range(0, len(hashes), CHUNK):
+        chunk = hashes[start : start + CHUNK]
+        values = MULTIPLIERS[:, None] * chunk[None, :] + INCREMENTS[:, None]
+        values >>= np.uint64(32)
+        np.minimum(signature, values.min(axis=1), out=signature)
+    return signature.astype(np.uint32)
+
+
+def update_signatures(con: sqlite3.Connection, content_hashes: Dict[str, int]) -> None:
+    """
+    Compute the signatures of the volume contents that don't have one yet. Volumes
+    with the same content share a signature, each content is read once, from any
+    volume that has it.
+    """
+    known = {
+        content_hash
+        for (content_hash,) in con.execute("select content_hash from VolumeSignatures")
+    }
+    missing = {
+        content_hash: volume_id
+        for content_hash, volume_id in content_hashes.items()
+        if content_hash not in known
+    }
+    logging.info(f"Computing the signatures of {len(missing)} volumes")
+    for done, (content_hash, volume_id) in enumerate(missing.items(), start=1):
+        texts = [
+            text
+            for (text,) in con.execute(
+                "select text from Pages where volume_id = ? order by page_number",
+                (volume_id,),
+            )
+        ]
+        hashes = shingles(texts)
+        # Too short to have a shingle, the volume is only its own duplicate
+        signature = minhash(hashes).tobytes() if len(hashes) else None
+        con.execute(
+            "insert or replace into VolumeSignatures (content_hash, length, signature) "
+            "values (?, ?, ?)",
+            (content_hash, sum(len(text) for text in texts), signature),
+        )
+        if done % 100 == 0:
+            con.commit()
+            logging.info(f"Computed {done} signatures")
+    con.commit()
+
+
+def candidate_pairs(signatures: np.ndarray) -> np.ndarray:
+    """
+    The pairs of rows of the signatures that are equal on at least one band, as an
+    array of (i, j) with i < j. Each band is bucketed by sorting, not compared
+    pairwise, so the cost grows with the number of volumes and of actual matches.
+    """
+    pairs = []
+    for band in range(BANDS):
+        keys = np.ascontiguousarray(signatures[:, band * ROWS : (band + 1) * ROWS])
+        keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * ROWS))).ravel()
+        order = np.argsort(keys, kind="stable")
+        _, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        for start, count in zip(starts[counts > 1], counts[counts > 1]):
+            members = order[start : start + count]
+            first, second = np.triu_indices(count, k=1)
+            pairs.append(np.column_stack([members[first], members[second]]))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def similarities(signatures: np.ndarray, pairs: np.ndarray) -> np.ndarray:
+    """The Jaccard similarity of each pair, estimated from their signatures."""
+    estimates = np.empty(len(pairs))
+    for start in range(0, len(pairs), CHUNK):
+        first, second = pairs[start : start + CHUNK].T
+        estimates[start : start + CHUNK] = (
+            signatures[first] == signatures[second]
+        ).mean(axis=1)
+    return estimates
+
+
+def find(parents: np.ndarray, node: int) -> int:
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+def clusters(count: int, pairs: np.ndarray) -> np.ndarray:
+    """Union-find over the matching pairs, returns the root of every node."""
+    parents = np.arange(count)
+    for first, second in pairs:
+        first, second = find(parents, first), find(parents, second)
+        if first != second:
+            parents[max(first, second)] = min(first, second)
+    return np.array([find(parents, node) for node in range(count)], dtype=np.int64)
+
+
+def canonical_volumes(
+    volumes: pd.DataFrame, signatures: np.ndarray, threshold: float = THRESHOLD
+) -> pd.DataFrame:
+    """
+    Map every volume to the canonical copy of its cluster of near-duplicates:
+    the copy from the title with the most volumes, then the longest, then the
+    first loaded. Volumes with the same content are always in the same cluster,
+    the ones without a signature only with their exact copies.
+    """
+    signed = np.flatnonzero(volumes["has_signature"].to_numpy())
+    pairs = candidate_pairs(signatures[signed])
+    estimates = similarities(signatures[signed], pairs)
+    matches = signed[pairs[estimates >= threshold]]
+    logging.info(
+        f"{len(pairs)} candidate pairs, {len(matches)} near-duplicates above {threshold}"
+    )
+    volumes = volumes.assign(cluster=clusters(len(volumes), matches))
+    volumes["cluster"] = volumes.groupby("content_hash")["cluster"].transform("min")
+    ranked = volumes.sort_values(
+        by=["cluster", "title_volume_count", "length", "id"],
+        ascending=[True, False, False, True],
+    )
+    canonical = ranked.drop_duplicates(subset=["cluster"]).set_index("cluster")["id"]
+    volumes["canonical_volume_id"] = volumes["cluster"].map(canonical)
+
+    # The similarity of each volume to its canonical copy, 1 for exact copies
+    rows = pd.Series(np.arange(len(volumes)), index=volumes["id"])
+    canonical_rows = rows.loc[volumes["canonical_volume_id"]].to_numpy()
+    volumes["similarity"] = similarities(
+        signatures, np.column_stack([np.arange(len(volumes)), canonical_rows])
+    )
+    same_content = (
+        volumes["content_hash"].to_numpy()
+        == volumes["content_hash"].to_numpy()[canonical_rows]
+    )
+    volumes.loc[same_content, "similarity"] = 1.0
+    return volumes.drop(columns="cluster")
+
+
+def save_mapping(con: sqlite3.Connection, volumes: pd.DataFrame) -> int:
+    """
+    Replace the stored mapping. The titles whose volumes became or stopped being
+    duplicates are logged as changed, for transform.py to recompute them. Returns
+    the number of duplicate volumes.
+    """
+    previous = dict(
+        con.execute(
+            "select volume_id, canonical_volume_id != volume_id from CanonicalVolumes"
+        ).fetchall()
+    )
+    duplicate = volumes["canonical_volume_id"] != volumes["id"]
+    changed = {
+        title_uuid
+        for volume_id, title_uuid, is_duplicate in zip(
+            volumes["id"], volumes["title_uuid"], duplicate
+        )
+        if bool(previous.get(volume_id, False)) != is_duplicate
+    }
+    con.execute("delete from CanonicalVolumes")
+    con.executemany(
+        "insert into CanonicalVolumes (volume_id, canonical_volume_id, similarity) "
+        "values (?, ?, ?)",
+        zip(
+            volumes["id"].tolist(),
+            volumes["canonical_volume_id"].tolist(),
+            volumes["similarity"].tolist(),
+        ),
+    )
+    con.executemany(
+        "insert into VolumeChanges (title_uuid) values (?)",
+        ((title_uuid,) for title_uuid in sorted(changed)),
+    )
+    con.commit()
+    return int(duplicate.sum())
+
+
+def export_duplicates(volumes: pd.DataFrame) -> None:
+    """Write the duplicate volumes next to their canonical copy, for review."""
+    canonical = volumes.set_index("id")[["title_uuid", "volume_number", "volume"]]
+    duplicates = volumes[volumes["canonical_volume_id"] != volumes["id"]].join(
+        canonical.add_prefix("canonical_"), on="canonical_volume_id"
+    )
+    duplicates[
+        [
+            "id",
+            "title_uuid",
+            "volume_number",
+            "volume",
+            "canonical_volume_id",
+            "canonical_title_uuid",
+            "canonical_volume_number",
+            "canonical_volume",
+            "similarity",
+        ]
+    ].rename(columns={"id": "volume_id"}).to_csv(DUPLICATES_PATH, index=False)
+    logging.info(f"Extracted the duplicate volumes to {DUPLICATES_PATH}")
+
+
+def load_signatures(
+    con: sqlite3.Connection, content_hashes: List[str]
+) -> Tuple[np.ndarray, np.ndarray, List[int]]:
+    """
+    The signatures and lengths of the given contents, in their order, and which
+    of them have a signature.
+    """
+    stored = {
+        content_hash: (length, signature)
+        for content_hash, length, signature in con.execute(
+            "select content_hash, length, signature from VolumeSignatures"
+        )
+    }
+    signatures = np.zeros((len(content_hashes), NUM_PERM), dtype=np.uint32)
+    has_signature = np.zeros(len(content_hashes), dtype=bool)
+    lengths = []
+    for row, content_hash in enumerate(content_hashes):
+        length, signature = stored[content_hash]
+        lengths.append(length)
+        if signature is not None:
+            signatures[row] = np.frombuffer(signature, dtype=np.uint32)
+            has_signature[row] = True
+    return signatures, has_signature, lengths
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Find the near-duplicate volumes and map them to a canonical copy."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="Estimated Jaccard similarity from which two volumes are duplicates",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    with sqlite3.connect("manga_ocr.db") as con:
+        create_tables(con)
+        volumes = pd.read_sql_query(VOLUMES_QUERY, con)
+        first_copies = volumes.drop_duplicates(subset=["content_hash"])
+        update_signatures(con, dict(zip(first_copies["content_hash"], first_copies["id"])))
+        signatures, has_signature, lengths = load_signatures(
+            con, volumes["content_hash"].tolist()
+        )
+        volumes["has_signature"] = has_signature
+        volumes["length"] = lengths
+        volumes = canonical_volumes(volumes, signatures, args.threshold)
+        duplicates = save_mapping(con, volumes)
+        logging.info(f"{duplicates} of {len(volumes)} volumes are duplicates")
+        export_duplicates(volumes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import hashlib
+import re
+import unicodedata
+import uuid
+from typing import Sequence
+
+# Title UUIDs are derived from the manga directory name in this namespace, so the
+# same directory gets the same title_uuid on every run
+TITLE_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://www.mokuro.moe/manga/")
+# Canonical UUIDs are derived from the normalized title in this one, so the
+# uploads of a series, e.g. its upscaled edition, share one canonical_uuid
+CANONICAL_NAMESPACE = uuid.uuid5(
+    uuid.NAMESPACE_URL, "https://www.mokuro.moe/manga/canonical/"
+)
+UPSCALED_MARKER = "(Upscaled)"
+
+
+def title_uuid_for(manga_dir: str) -> str:
+    """
+    Derive a stable title UUID (version 5) from the manga directory name, so joins
+    with dim_manga.csv and anilist_data.jsonl survive a rebuild.
+    """
+    return str(uuid.uuid5(TITLE_NAMESPACE, manga_dir))
+
+
+def canonical_title(title: str) -> str:
+    """The title without its edition marker, with Unicode, spacing and case folded."""
+    title = unicodedata.normalize("NFKC", title).replace(UPSCALED_MARKER, "")
+    return re.sub(r"\s+", " ", title).strip().casefold()
+
+
+def canonical_uuid_for(title: str) -> str:
+    """The UUID (version 5) shared by every upload of a title."""
+    return str(uuid.uuid5(CANONICAL_NAMESPACE, canonical_title(title)))
+
+
+def variant_of(title: str) -> str:
+    return "upscaled" if UPSCALED_MARKER in title else "original"
+
+
+def content_hash(pages: Sequence[str]) -> str:
+    """
+    SHA-256 of the text of a volume's pages, in order. It identifies a volume by
+    its content, whatever file or directory it was loaded from. Each page is
+    prefixed with its length so the page boundaries are part of the hash.
+    """
+    digest = hashlib.sha256()
+    for text in pages:
+        data = text.encode()
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
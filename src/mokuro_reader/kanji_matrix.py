@@ -0,0 +1,185 @@
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from stats import KANJI_FIRST, KANJI_SPAN
+
+MATRIX_PATH = Path("data/kanji_matrix.npz")
+
+
+@dataclass
+class KanjiMatrix:
+    """
+    Sparse volume-by-kanji count matrix in CSR layout.
+    Row i is the volume (title_uuid[i], volume_number[i]); the counts of its kanji
+    are data[indptr[i]:indptr[i + 1]], in the columns indices[indptr[i]:indptr[i + 1]].
+    Column j is the kanji with code point KANJI_FIRST + j.
+    canonical_uuid[i] is the canonical title of the row, the key of dim_manga, and
+    main[i] whether its upload is the one dim_manga is built from.
+    """
+
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    title_uuid: np.ndarray
+    volume_number: np.ndarray
+    canonical_uuid: Optional[np.ndarray] = None
+    main: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_rows(
+        cls,
+        keys: List[Tuple[str, int]],
+        rows: List[Tuple[np.ndarray, np.ndarray]],
+    ) -> "KanjiMatrix":
+        """Build the matrix from (title_uuid, volume_number) keys and (columns, counts) rows."""
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(columns) for columns, _ in rows], out=indptr[1:])
+        return cls(
+            indptr=indptr,
+            indices=np.concatenate(
+                [columns for columns, _ in rows] or [np.empty(0)]
+            ).astype(np.uint16),
+            data=np.concatenate([counts for _, counts in rows] or [np.empty(0)]).astype(
+                np.uint32
+            ),
+            title_uuid=np.array([title_uuid for title_uuid, _ in keys], dtype=str),
+            volume_number=np.array(
+                [volume_number for _, volume_number in keys], dtype=np.int64
+            ),
+        )
+
+    @classmethod
+    def load(cls, path: Path = MATRIX_PATH) -> "KanjiMatrix":
+        with np.load(path) as npz:
+            if int(npz["kanji_first"]) != KANJI_FIRST:
+                raise ValueError(f"{path} was built with a different kanji range")
+            return cls(
+                indptr=npz["indptr"],
+                indices=npz["indices"],
+                data=npz["data"],
+                title_uuid=npz["title_uuid"],
+                volume_number=npz["volume_number"],
+                # Matrices saved before the canonical titles were kept don't have them
+                canonical_uuid=npz["canonical_uuid"] if "main" in npz else None,
+                main=npz["main"] if "main" in npz else None,
+            )
+
+    def save(self, path: Path = MATRIX_PATH) -> None:
+        variants = {}
+        if self.main is not None:
+            variants = {"canonical_uuid": self.canonical_uuid, "main": self.main}
+        np.savez_compressed(
+            path,
+            indptr=self.indptr,
+            indices=self.indices,
+            data=self.data,
+            title_uuid=self.title_uuid,
+            volume_number=self.volume_number,
+            kanji_first=KANJI_FIRST,
+            **variants,
+        )
+
+    def with_variants(
+        self, canonical_uuids: Dict[str, str], main_uuids: Set[str]
+    ) -> "KanjiMatrix":
+        """
+        The matrix with the canonical title of every row and whether it's the main
+        upload, from the title_uuid to canonical_uuid map and the main uploads.
+        """
+        return replace(
+            self,
+            canonical_uuid=np.array(
+                [canonical_uuids.get(str(uuid), "") for uuid in self.title_uuid],
+                dtype=str,
+            ),
+            main=np.isin(self.title_uuid, list(main_uuids)),
+        )
+
+    def replace_titles(
+        self, title_uuids: Set[str], replacement: "KanjiMatrix"
+    ) -> "KanjiMatrix":
+        """Swap the rows of the given titles for the rows of another matrix."""
+        keep = np.flatnonzero(~np.isin(self.title_uuid, list(title_uuids)))
+        keys = [(str(self.title_uuid[i]), int(self.volume_number[i])) for i in keep]
+        rows = [self.row(i) for i in keep]
+        keys += [
+            (str(title_uuid), int(volume_number))
+            for title_uuid, volume_number in zip(
+                replacement.title_uuid, replacement.volume_number
+            )
+        ]
+        rows += [replacement.row(i) for i in range(replacement.shape[0])]
+        return KanjiMatrix.from_rows(keys, rows)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.indptr) - 1, KANJI_SPAN
+
+    def row(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The columns and counts of a volume."""
+        start, end = self.indptr[index], self.indptr[index + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def title_rows(self, title_uuid: str) -> np.ndarray:
+        """
+        The rows of a title's volumes, in volume order. A canonical UUID, as in
+        dim_manga, stands for the main upload of the title.
+        """
+        selected = self.title_uuid == title_uuid
+        if not selected.any() and self.main is not None:
+            selected = (self.canonical_uuid == title_uuid) & self.main
+        rows = np.flatnonzero(selected)
+        return rows[np.argsort(self.volume_number[rows], kind="stable")]
+
+    def counts(self, rows: np.ndarray = None) -> np.ndarray:
+        """Dense kanji counts summed over the given rows, all rows by default."""
+        if rows is None:
+            return np.bincount(
+                self.indices, weights=self.data, minlength=KANJI_SPAN
+            ).astype(np.int64)
+        totals = np.zeros(KANJI_SPAN, dtype=np.int64)
+        for index in rows:
+            columns, counts = self.row(index)
+            totals[columns] += counts
+        return totals
+
+    def title_counts(self, title_uuid: str) -> np.ndarray:
+        return self.counts(self.title_rows(title_uuid))
+
+    def shared_kanji(self, title_uuid: str, other_title_uuid: str) -> str:
+        """The kanji used by both titles."""
+        shared = (self.title_counts(title_uuid) > 0) & (
+            self.title_counts(other_title_uuid) > 0
+        )
+        return "".join(chr(KANJI_FIRST + column) for column in np.flatnonzero(shared))
+
+    def top_kanji(self, n: int) -> np.ndarray:
+        """The columns of the n most frequent kanji of the corpus."""
+        totals = self.counts()
+        return np.argsort(-totals, kind="stable")[: min(n, np.count_nonzero(totals))]
+
+    def coverage(self, title_uuid: str, n: int) -> float:
+        """Share of a title's kanji occurrences covered by the corpus' top n kanji."""
+        counts = self.title_counts(title_uuid)
+        total = counts.sum()
+        if total == 0:
+            return 0.0
+        return float(counts[self.top_kanji(n)].sum() / total)
+
+    def new_kanji_per_volume(self, title_uuid: str) -> List[Tuple[int, int]]:
+        """
+        For each volume of a title, in order, the number of kanji that didn't
+        appear in any earlier volume of the title.
+        """
+        seen = np.zeros(KANJI_SPAN, dtype=bool)
+        new_kanji = []
+        for index in self.title_rows(title_uuid):
+            columns, _ = self.row(index)
+            new_kanji.append(
+                (int(self.volume_number[index]), int(np.count_nonzero(~seen[columns])))
+            )
+            seen[columns] = True
+        return new_kanji
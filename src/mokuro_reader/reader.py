@@ -1,36 +1,68 @@
+import argparse
+import hashlib
 import json
+import os
 import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
 import logging
-from typing import List
-import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from identity import canonical_uuid_for, content_hash, title_uuid_for, variant_of
+from schema import (
+    create_indexes,
+    create_search_triggers,
+    create_tables,
+    drop_indexes,
+    drop_search_triggers,
+    index_page_chars,
+    rebuild_search_index,
+    unindex_page_chars,
+)
+
+try:
+    import msgspec
+except ImportError:  # optional, see the "fast" extra
+    msgspec = None
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+PREFETCH_PER_WORKER = 4
+BULK_BATCH_SIZE = 200
 
-def create_tables(conn: sqlite3.Connection) -> None:
-    """Create the necessary database tables if they don't already exist."""
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS Volumes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            volume TEXT,
-            volume_number INTEGER,
-            title_uuid TEXT,
-            volume_uuid TEXT
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS Pages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            volume_id INTEGER,
-            page_number INTEGER,
-            text TEXT,
-            FOREIGN KEY(volume_id) REFERENCES Volumes(id)
-        )
-    """)
-    conn.commit()
+if msgspec is not None:
+    # Only the fields we need are declared, the decoder skips the rest of the
+    # document (box coordinates, font sizes, image paths...) without building it
+    class MokuroBlock(msgspec.Struct):
+        lines: List[str] = []
+
+    class MokuroPage(msgspec.Struct):
+        blocks: List[MokuroBlock] = []
+
+    class MokuroVolume(msgspec.Struct):
+        title: str = ""
+        volume: str = ""
+        volume_uuid: str = ""
+        pages: List[MokuroPage] = []
+
+    volume_decoder = msgspec.json.Decoder(MokuroVolume)
+    DECODE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError, msgspec.DecodeError)
+else:
+    DECODE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+
+
+def configure_bulk_load(conn: sqlite3.Connection, cache_size_mb: int) -> None:
+    """
+    Trade durability for speed while loading: a crash during the initial load
+    means rerunning it anyway.
+    """
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    # A negative cache size is expressed in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size = {-cache_size_mb * 1024}")
 
 
 def extract_page_text(page: List[dict]) -> str:
@@ -44,85 +76,447 @@ def extract_page_text(page: List[dict]) -> str:
     )
 
 
-def generate_uuid() -> str:
+def extract_page_joiners(page: List[dict]) -> int:
+    """The number of full stops extract_page_text puts between the lines of a page."""
+    return sum(
+        max(len(block.get("lines", [])) - 1, 0) for block in page.get("blocks", [])
+    )
+
+
+def source_path_for(volume_file: Path, data_folder: Path) -> str:
+    """The path of a volume file relative to the data folder, as stored in Volumes."""
+    return volume_file.relative_to(data_folder).as_posix()
+
+
+def decode_volume(raw: bytes) -> dict:
+    """Decode a volume with the standard library json module."""
+    data = json.loads(raw)
+    return {
+        "title": data.get("title", ""),
+        "volume": data.get("volume", ""),
+        "volume_uuid": data.get("volume_uuid", ""),
+        "pages": [extract_page_text(page) for page in data.get("pages", [])],
+        "joiners": [extract_page_joiners(page) for page in data.get("pages", [])],
+    }
+
+
+def decode_volume_typed(raw: bytes) -> dict:
     """
-    Generates a UUID version 4 as a string
+    Decode a volume with msgspec against the MokuroVolume schema, which only
+    materializes the titles and the lines of each block.
     """
-    return str(uuid.uuid4())
+    data = volume_decoder.decode(raw)
+    return {
+        "title": data.title,
+        "volume": data.volume,
+        "volume_uuid": data.volume_uuid,
+        "pages": [
+            "\n".join("。".join(block.lines) for block in page.blocks)
+            for page in data.pages
+        ],
+        "joiners": [
+            sum(max(len(block.lines) - 1, 0) for block in page.blocks)
+            for page in data.pages
+        ],
+    }
 
 
-def process_volume_file(
-    volume_file: Path,
-    conn: sqlite3.Connection,
-    title_uuid: str = None,
-    volume_count: int = 1,
-) -> None:
+def default_parser() -> str:
+    return "msgspec" if msgspec is not None else "json"
+
+
+def load_volume(volume_file: Path, parser: str = "json") -> Optional[dict]:
     """
-    Process a single JSON file representing a volume:
-    - Load the JSON
-    - Insert the volume metadata into the Volumes table
-    - Insert each page's aggregated text into the Pages table
+    Parse a single JSON file representing a volume and aggregate its pages' text.
+    Returns None if the file can't be read. This runs in the worker processes, so
+    it must not touch the database.
     """
+    decode = decode_volume_typed if parser == "msgspec" else decode_volume
     try:
-        with open(volume_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except json.JSONDecodeError as e:
+        with open(volume_file, "rb") as f:
+            raw = f.read()
+        volume = decode(raw)
+    except DECODE_ERRORS as e:
         logging.error(f"JSON decode error in {volume_file.name}: {e}")
-        return
+        return None
     except Exception as e:
         logging.error(f"Error reading {volume_file.name}: {e}")
-        return
+        return None
 
-    logging.info(f"Processing volume: {volume_file.name}")
+    volume["name"] = volume_file.name
+    volume["file_size"] = len(raw)
+    volume["file_hash"] = hashlib.sha256(raw).hexdigest()
+    volume["content_hash"] = content_hash(volume["pages"])
+    return volume
 
-    # Extract volume-level metadata
-    title = data.get("title", "")
-    volume_title = data.get("volume", "")
-    if title_uuid is None:
-        title_uuid = generate_uuid()
-    volume_uuid = data.get("volume_uuid", "")
 
+def insert_volume(
+    conn: sqlite3.Connection,
+    volume: dict,
+    title_uuid: str,
+    volume_count: int,
+    index_chars: bool = True,
+) -> None:
+    """
+    Insert the volume metadata into the Volumes table and each page's aggregated
+    text into the Pages table, registering the title and the canonical title it's
+    a variant of. The pages are added to the character index unless index_chars
+    is False, e.g. when it's rebuilt after a bulk load. The caller is responsible
+    for committing.
+    """
+    logging.info(f"Processing volume: {volume['name']}")
     cur = conn.cursor()
+    source_path = volume.get("source_path")
+    cur.execute(
+        """
+        INSERT INTO Titles (title_uuid, title, directory)
+        VALUES (?, ?, ?)
+        ON CONFLICT (title_uuid) DO UPDATE SET
+            title = excluded.title,
+            directory = coalesce(excluded.directory, directory)
+    """,
+        (
+            title_uuid,
+            volume["title"],
+            source_path.split("/", 1)[0] if source_path else None,
+        ),
+    )
+    cur.execute(
+        """
+        INSERT INTO TitleVariants (title_uuid, canonical_uuid, variant)
+        VALUES (?, ?, ?)
+        ON CONFLICT (title_uuid) DO UPDATE SET
+            canonical_uuid = excluded.canonical_uuid,
+            variant = excluded.variant
+    """,
+        (title_uuid, canonical_uuid_for(volume["title"]), variant_of(volume["title"])),
+    )
     cur.execute(
         """
-        INSERT INTO Volumes (title, volume, volume_number, title_uuid, volume_uuid)
-        VALUES (?, ?, ?, ?, ?)
+        INSERT INTO Volumes (
+            title, volume, volume_number, title_uuid, volume_uuid,
+            source_path, file_mtime, file_size, file_hash, content_hash
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """,
-        (title, volume_title, volume_count, title_uuid, volume_uuid),
+        (
+            volume["title"],
+            volume["volume"],
+            volume_count,
+            title_uuid,
+            volume["volume_uuid"],
+            source_path,
+            volume.get("file_mtime"),
+            volume["file_size"],
+            volume["file_hash"],
+            volume["content_hash"],
+        ),
     )
     volume_id = cur.lastrowid
 
-    pages = data.get("pages", [])
-    for page_number, page in enumerate(pages, start=1):
-        text = extract_page_text(page)
-        cur.execute(
-            """
-            INSERT INTO Pages (volume_id, page_number, text)
-            VALUES (?, ?, ?)
-        """,
-            (volume_id, page_number, text),
+    cur.executemany(
+        """
+        INSERT INTO Pages (volume_id, page_number, text, joiners)
+        VALUES (?, ?, ?, ?)
+    """,
+        (
+            (volume_id, page_number, text, joiners)
+            for page_number, (text, joiners) in enumerate(
+                zip(volume["pages"], volume["joiners"]), start=1
+            )
+        ),
+    )
+    if index_chars:
+        pages = conn.execute(
+            "SELECT id, text FROM Pages WHERE volume_id = ?", (volume_id,)
         )
+        index_page_chars(conn, pages)
 
+
+def delete_volumes(conn: sqlite3.Connection, volume_ids: List[int]) -> None:
+    """
+    Delete volumes along with their pages and their duplicate mappings. The copies
+    of a deleted volume count again, their titles are logged as changed. The caller
+    is responsible for committing.
+    """
+    cur = conn.cursor()
+    cur.executemany(
+        """
+        INSERT INTO VolumeChanges (title_uuid)
+        SELECT v.title_uuid FROM CanonicalVolumes cv
+        INNER JOIN Volumes v ON v.id = cv.volume_id
+        WHERE cv.canonical_volume_id = ? AND cv.volume_id != cv.canonical_volume_id
+    """,
+        ((id_,) for id_ in volume_ids),
+    )
+    cur.executemany(
+        "DELETE FROM CanonicalVolumes WHERE volume_id = ? OR canonical_volume_id = ?",
+        ((id_, id_) for id_ in volume_ids),
+    )
+    for id_ in volume_ids:
+        unindex_page_chars(
+            conn, conn.execute("SELECT id, text FROM Pages WHERE volume_id = ?", (id_,))
+        )
+    cur.executemany(
+        "DELETE FROM Pages WHERE volume_id = ?", ((id_,) for id_ in volume_ids)
+    )
+    cur.executemany("DELETE FROM Volumes WHERE id = ?", ((id_,) for id_ in volume_ids))
+
+
+def clear_volumes(conn: sqlite3.Connection) -> None:
+    """
+    Delete every loaded volume, a load without --incremental parses all of them
+    again. Their titles are logged as changed, like any deleted volume.
+    """
+    drop_search_triggers(conn)
+    cur = conn.cursor()
+    for table in ("CanonicalVolumes", "Pages", "Volumes", "TitleVariants", "Titles"):
+        cur.execute(f"DELETE FROM {table}")
+    rebuild_search_index(conn)
+    create_search_triggers(conn)
+
+
+def load_fingerprints(conn: sqlite3.Connection) -> Dict[str, dict]:
+    """
+    Return the stored volumes keyed by their source path. Volumes loaded before
+    fingerprints were tracked are keyed by None.
+    """
+    cur = conn.execute(
+        """
+        SELECT id, source_path, file_mtime, file_size, file_hash, volume_uuid,
+            title_uuid, volume_number
+        FROM Volumes
+    """
+    )
+    columns = [column[0] for column in cur.description]
+    fingerprints = {}
+    for row in cur:
+        stored = dict(zip(columns, row))
+        fingerprints.setdefault(stored["source_path"], []).append(stored)
+    return fingerprints
+
+
+def list_volume_files(data_folder: Path) -> List[Tuple[Path, str, int]]:
+    """
+    Walk the manga directories in sorted order and assign each volume file its
+    title_uuid and volume number. Doing this up front keeps the assignment
+    deterministic no matter in which order the files get parsed.
+    """
+    volume_files = []
+    for manga_dir in sorted(data_folder.iterdir()):
+        # Sometimes a manga can have a different uuid for the same volume, lets make it constant
+        title_uuid = title_uuid_for(manga_dir.name)
+        volume_count = 1
+        if manga_dir.is_dir():
+            for volume_file in sorted(manga_dir.iterdir()):
+                if volume_file.is_file() and volume_file.suffix == ".mokuro":
+                    volume_files.append((volume_file, title_uuid, volume_count))
+                    volume_count += 1
+                else:
+                    logging.warning(f"Skipping non-JSON file: {volume_file.name}")
+    return volume_files
+
+
+def load_volumes(
+    volume_files: List[Path], workers: int, parser: str = "json"
+) -> Iterator[Optional[dict]]:
+    """
+    Parse the volume files in a process pool and yield them in their original
+    order. Only a bounded number of files are in flight at once so parsed
+    volumes don't pile up in memory while the writer catches up.
+    """
+    if workers <= 1:
+        for volume_file in volume_files:
+            yield load_volume(volume_file, parser)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        files = iter(volume_files)
+        for volume_file in islice(files, workers * PREFETCH_PER_WORKER):
+            pending.append(executor.submit(load_volume, volume_file, parser))
+        while pending:
+            volume = pending.popleft().result()
+            volume_file = next(files, None)
+            if volume_file is not None:
+                pending.append(executor.submit(load_volume, volume_file, parser))
+            yield volume
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load .mokuro files into SQLite.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes parsing the volume files (1 disables the pool)",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Initial load: WAL, synchronous=OFF, indexes built after loading",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Number of volumes per transaction (default: 1, or 200 with --bulk)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=512,
+        help="SQLite page cache size in MiB used with --bulk",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only load new or modified volume files and drop the deleted ones",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=["json", "msgspec"],
+        default=default_parser(),
+        help="JSON decoder, msgspec only decodes the fields that are loaded",
+    )
+    return parser.parse_args()
+
+
+def plan_incremental_load(
+    conn: sqlite3.Connection,
+    volume_files: List[Tuple[Path, str, int]],
+    data_folder: Path,
+) -> Tuple[List[Tuple[Path, str, int]], Dict[str, dict]]:
+    """
+    Compare the volume files on disk with the stored fingerprints.
+    Volumes whose file is unchanged only get their numbering refreshed, volumes
+    whose file is gone (or that were loaded without a fingerprint) are deleted.
+    Returns the files that have to be parsed, along with the stored volume for
+    each source path that may be replaced.
+    """
+    fingerprints = load_fingerprints(conn)
+    stale = [stored["id"] for stored in fingerprints.pop(None, [])]
+    stored_by_path = {}
+    for source_path, stored in fingerprints.items():
+        # Keep the latest copy, older duplicates come from non-incremental runs
+        *duplicates, stored_by_path[source_path] = stored
+        stale.extend(duplicate["id"] for duplicate in duplicates)
+
+    to_load = []
+    seen = set()
+    cur = conn.cursor()
+    for volume_file, title_uuid, volume_count in volume_files:
+        source_path = source_path_for(volume_file, data_folder)
+        seen.add(source_path)
+        stored = stored_by_path.get(source_path)
+        stat = volume_file.stat()
+        if (
+            stored is not None
+            and stored["file_mtime"] == stat.st_mtime_ns
+            and stored["file_size"] == stat.st_size
+        ):
+            if (stored["title_uuid"], stored["volume_number"]) != (
+                title_uuid,
+                volume_count,
+            ):
+                cur.execute(
+                    "UPDATE Volumes SET title_uuid = ?, volume_number = ? WHERE id = ?",
+                    (title_uuid, volume_count, stored["id"]),
+                )
+            continue
+        to_load.append((volume_file, title_uuid, volume_count))
+
+    stale.extend(
+        stored["id"]
+        for source_path, stored in stored_by_path.items()
+        if source_path not in seen
+    )
+    if stale:
+        logging.info(f"Deleting {len(stale)} stale volumes")
+        delete_volumes(conn, stale)
+        cur.execute(
+            "DELETE FROM Titles WHERE title_uuid NOT IN (SELECT title_uuid FROM Volumes)"
+        )
+        cur.execute(
+            "DELETE FROM TitleVariants "
+            "WHERE title_uuid NOT IN (SELECT title_uuid FROM Volumes)"
+        )
     conn.commit()
+    logging.info(
+        f"{len(to_load)} of {len(volume_files)} volume files are new or modified"
+    )
+    return to_load, stored_by_path
 
 
 def main() -> None:
+    args = parse_args()
     db_path = "manga_ocr.db"
     data_folder = Path("mokuro")
 
+    volume_files = list_volume_files(data_folder)
+    batch_size = args.batch_size or (BULK_BATCH_SIZE if args.bulk else 1)
     with sqlite3.connect(db_path) as conn:
         create_tables(conn)
-        for manga_dir in sorted(data_folder.iterdir()):
-            title_uuid = generate_uuid()  # Sometimes a manga can have a different uuid for the same volume, lets make it constant
-            volume_count = 1
-            if manga_dir.is_dir():
-                logging.info(f"Processing manga: {manga_dir.name}")
-                for volume_file in sorted(manga_dir.iterdir()):
-                    if volume_file.is_file() and volume_file.suffix == ".mokuro":
-                        process_volume_file(volume_file, conn, title_uuid, volume_count)
-                        volume_count += 1
-                    else:
-                        logging.warning(f"Skipping non-JSON file: {volume_file.name}")
+        stored_by_path = {}
+        if args.incremental:
+            volume_files, stored_by_path = plan_incremental_load(
+                conn, volume_files, data_folder
+            )
+        elif conn.execute("SELECT 1 FROM Volumes LIMIT 1").fetchone():
+            # The title_uuids are stable, a second copy would merge with the first
+            logging.info("Deleting the loaded volumes, use --incremental to keep them")
+            clear_volumes(conn)
+        # Replacing volumes needs the indexes to find their pages, an initial bulk
+        # load builds them and the search indexes once it's done
+        rebuild_search = args.bulk and not args.incremental
+        if args.bulk:
+            configure_bulk_load(conn, args.cache_size)
+            if rebuild_search:
+                drop_indexes(conn)
+                drop_search_triggers(conn)
+        # The workers only parse, this process is the single writer
+        pending = 0
+        paths = [volume_file for volume_file, _, _ in volume_files]
+        for (volume_file, title_uuid, volume_count), volume in zip(
+            volume_files, load_volumes(paths, args.workers, args.parser)
+        ):
+            if volume is None:
+                continue
+            source_path = source_path_for(volume_file, data_folder)
+            volume["source_path"] = source_path
+            volume["file_mtime"] = volume_file.stat().st_mtime_ns
+            stored = stored_by_path.get(source_path)
+            if stored is not None:
+                if (stored["file_hash"], stored["volume_uuid"]) == (
+                    volume["file_hash"],
+                    volume["volume_uuid"],
+                ):
+                    # Touched but not modified
+                    conn.execute(
+                        """
+                        UPDATE Volumes
+                        SET file_mtime = ?, title_uuid = ?, volume_number = ?
+                        WHERE id = ?
+                    """,
+                        (volume["file_mtime"], title_uuid, volume_count, stored["id"]),
+                    )
+                    continue
+                delete_volumes(conn, [stored["id"]])
+            insert_volume(
+                conn, volume, title_uuid, volume_count, index_chars=not rebuild_search
+            )
+            pending += 1
+            if pending >= batch_size:
+                conn.commit()
+                pending = 0
+        conn.commit()
+        logging.info("Creating indexes")
+        create_indexes(conn)
+        if rebuild_search:
+            logging.info("Rebuilding the full-text search indexes")
+            rebuild_search_index(conn)
+            create_search_triggers(conn)
+        conn.execute("PRAGMA optimize")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+import pandas as pd
+
+from identity import canonical_uuid_for
+
+# The records src/utils/anilist.py and src/utils/kitsu.py fetched per title, they
+# resume by title_uuid and the general view joins them with dim_manga by it
+ANILIST_PATH = Path("data/anilist_data.jsonl")
+GENRES_PATH = Path("data/genres.jsonl")
+# The Parquet copy of the AniList records, read instead of them when it exists
+ANILIST_PARQUET = Path("data/anilist_data.parquet")
+
+
+def previous_canonical_uuids(
+    dim_manga: Optional[pd.DataFrame], known: Set[str]
+) -> Dict[str, str]:
+    """
+    The canonical UUID of the titles of a dim_manga built before it was keyed by
+    canonical title, e.g. by random UUIDs, derived from their clean title.
+    """
+    if dim_manga is None:
+        return {}
+    legacy = dim_manga[~dim_manga["title_uuid"].isin(known)].dropna(
+        subset=["clean_title"]
+    )
+    return {
+        title_uuid: canonical_uuid_for(clean_title)
+        for title_uuid, clean_title in zip(legacy["title_uuid"], legacy["clean_title"])
+    }
+
+
+def canonical_key(
+    record: dict, canonical_uuids: Dict[str, str], known: Set[str]
+) -> Optional[str]:
+    """
+    The canonical UUID of a record: from the UUID it's keyed by, or from the title
+    it was searched with when the UUID is unknown. None when neither is known.
+    """
+    title_uuid = record.get("title_uuid")
+    if title_uuid in known:
+        return title_uuid
+    if title_uuid in canonical_uuids:
+        return canonical_uuids[title_uuid]
+    title = record.get("title")
+    if isinstance(title, str) and canonical_uuid_for(title) in known:
+        return canonical_uuid_for(title)
+    return None
+
+
+def rekey_records(path: Path, canonical_uuids: Dict[str, str], known: Set[str]) -> int:
+    """
+    Rewrite the records of a JSON Lines file that aren't keyed by a canonical UUID
+    yet. Returns the number of records rewritten.
+    """
+    if not path.exists():
+        return 0
+    rekeyed = 0
+    lines = []
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash is kept as it is
+                lines.append(line)
+                continue
+            title_uuid = canonical_key(record, canonical_uuids, known)
+            if title_uuid is not None and title_uuid != record.get("title_uuid"):
+                record["title_uuid"] = title_uuid
+                line = json.dumps(record) + "\n"
+                rekeyed += 1
+            lines.append(line)
+    if rekeyed:
+        temporary = path.with_name(f"{path.name}.tmp")
+        with open(temporary, "w") as file:
+            file.writelines(lines)
+        os.replace(temporary, path)
+        logging.info(f"Keyed {rekeyed} records of {path} by canonical title")
+    return rekeyed
+
+
+def rekey_enrichments(
+    variants: pd.DataFrame, dim_manga: Optional[pd.DataFrame]
+) -> None:
+    """
+    Key the fetched records like dim_manga, by canonical UUID, whether they were
+    keyed by the title_uuid of an upload or by the UUIDs of a previous dim_manga.
+    dim_manga is the table about to be replaced.
+    """
+    known = set(variants["canonical_uuid"])
+    canonical_uuids = dict(zip(variants["title_uuid"], variants["canonical_uuid"]))
+    canonical_uuids.update(previous_canonical_uuids(dim_manga, known))
+    rekey_records(GENRES_PATH, canonical_uuids, known)
+    if rekey_records(ANILIST_PATH, canonical_uuids, known) and ANILIST_PARQUET.exists():
+        # It still has the old keys, src/utils/anilist.py writes it again
+        ANILIST_PARQUET.unlink()
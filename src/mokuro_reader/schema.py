@@ -0,0 +1,492 @@
+import logging
+import sqlite3
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterable, Tuple
+
+from identity import canonical_uuid_for, content_hash, variant_of
+
+
+def create_tables(conn: sqlite3.Connection) -> None:
+    """Create the necessary database tables if they don't already exist."""
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS Volumes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            volume TEXT,
+            volume_number INTEGER,
+            title_uuid TEXT,
+            volume_uuid TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS Pages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            volume_id INTEGER,
+            page_number INTEGER,
+            text TEXT,
+            FOREIGN KEY(volume_id) REFERENCES Volumes(id)
+        )
+    """)
+    conn.commit()
+    migrate(conn)
+    ensure_search_triggers(conn)
+    catch_up_char_search(conn)
+
+
+def spaced(text: str) -> str:
+    """Separate the characters of a text, PagesCharSearch indexes each as a token."""
+    return " ".join(text or "")
+
+
+def index_page_chars(
+    conn: sqlite3.Connection, pages: Iterable[Tuple[int, str]]
+) -> None:
+    """
+    Add pages, as (id, text), to PagesCharSearch. It's written from here rather
+    than by triggers, which would need spaced on every connection writing Pages.
+    """
+    conn.executemany(
+        "INSERT INTO PagesCharSearch (rowid, text) VALUES (?, ?)",
+        ((page_id, spaced(text)) for page_id, text in pages),
+    )
+
+
+def unindex_page_chars(
+    conn: sqlite3.Connection, pages: Iterable[Tuple[int, str]]
+) -> None:
+    """Remove pages from PagesCharSearch, which is told the text it indexed."""
+    conn.executemany(
+        "INSERT INTO PagesCharSearch (PagesCharSearch, rowid, text) "
+        "VALUES ('delete', ?, ?)",
+        ((page_id, spaced(text)) for page_id, text in pages),
+    )
+
+
+def catch_up_char_search(conn: sqlite3.Connection) -> None:
+    """
+    Index the pages added since the last indexed one, by another client or by a
+    load that was interrupted. Page ids are never reused: the pages another client
+    deletes stay in the index but can't match, search_pages joins Pages.
+    """
+    (last_indexed,) = conn.execute(
+        "SELECT coalesce(max(rowid), 0) FROM PagesCharSearch"
+    ).fetchone()
+    (missing,) = conn.execute(
+        "SELECT count(*) FROM Pages WHERE id > ?", (last_indexed,)
+    ).fetchone()
+    if not missing:
+        return
+    logging.info(f"Indexing the characters of {missing} pages")
+    index_page_chars(
+        conn, conn.execute("SELECT id, text FROM Pages WHERE id > ?", (last_indexed,))
+    )
+    conn.commit()
+
+
+def add_volume_fingerprints(conn: sqlite3.Connection) -> None:
+    """Track the file each volume was loaded from, to support incremental loads."""
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE Volumes ADD COLUMN source_path TEXT")
+    cur.execute("ALTER TABLE Volumes ADD COLUMN file_mtime INTEGER")
+    cur.execute("ALTER TABLE Volumes ADD COLUMN file_size INTEGER")
+    cur.execute("ALTER TABLE Volumes ADD COLUMN file_hash TEXT")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_volumes_source_path ON Volumes (source_path)"
+    )
+
+
+def add_titles(conn: sqlite3.Connection) -> None:
+    """
+    Move the per-title attributes to their own table, backfilled from Volumes, and
+    index the columns the analytics queries join on.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS Titles (
+            title_uuid TEXT PRIMARY KEY,
+            title TEXT,
+            directory TEXT
+        )
+    """)
+    cur.execute("""
+        INSERT OR IGNORE INTO Titles (title_uuid, title, directory)
+        SELECT
+            title_uuid,
+            min(title),
+            min(substr(source_path, 1, instr(source_path, '/') - 1))
+        FROM Volumes
+        WHERE title_uuid IS NOT NULL
+        GROUP BY title_uuid
+    """)
+    create_indexes(conn)
+
+
+def add_page_search(conn: sqlite3.Connection) -> None:
+    """
+    Index the page text for full-text search. The trigram tokenizer matches any
+    substring of three characters or more, so Japanese doesn't need a segmenter.
+    The index is external content: it stores the trigrams, the text stays in Pages.
+    ensure_search_triggers fills it and creates its triggers.
+    """
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS PagesSearch USING fts5 (
+            text,
+            content = 'Pages',
+            content_rowid = 'id',
+            tokenize = 'trigram'
+        )
+    """)
+
+
+def add_transform_tables(conn: sqlite3.Connection) -> None:
+    """
+    Log which titles had volumes added, removed or renumbered, and store the
+    statistics transform.py derives from them, so it only has to recompute the
+    titles that changed since its last build.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS VolumeChanges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title_uuid TEXT,
+            changed_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS volume_changes_insert AFTER INSERT ON Volumes BEGIN
+            INSERT INTO VolumeChanges (title_uuid) VALUES (new.title_uuid);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS volume_changes_delete AFTER DELETE ON Volumes BEGIN
+            INSERT INTO VolumeChanges (title_uuid) VALUES (old.title_uuid);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS volume_changes_update
+        AFTER UPDATE OF title, volume, volume_number, title_uuid ON Volumes BEGIN
+            INSERT INTO VolumeChanges (title_uuid) VALUES (old.title_uuid);
+            INSERT INTO VolumeChanges (title_uuid) VALUES (new.title_uuid);
+        END
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS TransformState (
+            key TEXT PRIMARY KEY,
+            value
+        )
+    """)
+    category_columns = ", ".join(
+        f"num_of_{category} INTEGER"
+        for category in ("other", "kanji", "hiragana", "katakana", "punctuation")
+    )
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS TitleStats (
+            title_uuid TEXT PRIMARY KEY,
+            title TEXT,
+            page_count INTEGER,
+            volume_count INTEGER,
+            num_of_unique_chrs INTEGER,
+            num_of_chrs INTEGER,
+            {category_columns}
+        )
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS VolumeStats (
+            title_uuid TEXT,
+            volume_number INTEGER,
+            title TEXT,
+            length INTEGER,
+            page_count INTEGER,
+            {category_columns},
+            PRIMARY KEY (title_uuid, volume_number)
+        )
+    """)
+
+
+def add_page_stats(conn: sqlite3.Connection) -> None:
+    """
+    Store per-page statistics, page_index numbers the pages of a title across its
+    volumes. The next transform.py build has to fill them for every title, so the
+    record of the last build is dropped.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS PageStats (
+            title_uuid TEXT,
+            page_index INTEGER,
+            volume_number INTEGER,
+            page_number INTEGER,
+            length INTEGER,
+            new_kanji INTEGER,
+            unique_kanji INTEGER,
+            PRIMARY KEY (title_uuid, page_index)
+        )
+    """)
+    cur.execute("DELETE FROM TransformState WHERE key = 'last_change_id'")
+
+
+def add_title_variants(conn: sqlite3.Connection) -> None:
+    """
+    Map every title to the canonical title it's an upload of, e.g. its upscaled
+    edition, and hash the text of every volume so the same volume is recognized
+    whichever file it was loaded from. Both are backfilled from the loaded data.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS TitleVariants (
+            title_uuid TEXT PRIMARY KEY,
+            canonical_uuid TEXT,
+            variant TEXT
+        )
+    """)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_title_variants_canonical "
+        "ON TitleVariants (canonical_uuid)"
+    )
+    titles = conn.execute("SELECT title_uuid, title FROM Titles").fetchall()
+    cur.executemany(
+        "INSERT OR IGNORE INTO TitleVariants (title_uuid, canonical_uuid, variant) "
+        "VALUES (?, ?, ?)",
+        (
+            (title_uuid, canonical_uuid_for(title or ""), variant_of(title or ""))
+            for title_uuid, title in titles
+        ),
+    )
+    cur.execute("ALTER TABLE Volumes ADD COLUMN content_hash TEXT")
+    pages = conn.execute(
+        "SELECT volume_id, text FROM Pages ORDER BY volume_id, page_number"
+    )
+    cur.executemany(
+        "UPDATE Volumes SET content_hash = ? WHERE id = ?",
+        (
+            (content_hash([text or "" for _, text in volume_pages]), volume_id)
+            for volume_id, volume_pages in groupby(pages, key=itemgetter(0))
+        ),
+    )
+    # Volumes without pages hash like any other empty volume
+    cur.execute(
+        "UPDATE Volumes SET content_hash = ? WHERE content_hash IS NULL",
+        (content_hash([]),),
+    )
+
+
+def add_volume_dedup(conn: sqlite3.Connection) -> None:
+    """
+    Store the MinHash signature of every volume content and the canonical copy of
+    every volume, both filled by dedup.py. transform.py skips the volumes whose
+    canonical copy is another volume.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS VolumeSignatures (
+            content_hash TEXT PRIMARY KEY,
+            length INTEGER,
+            signature BLOB
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS CanonicalVolumes (
+            volume_id INTEGER PRIMARY KEY,
+            canonical_volume_id INTEGER,
+            similarity REAL
+        )
+    """)
+
+
+def add_page_tokens(conn: sqlite3.Connection) -> None:
+    """
+    Cache the word counts vocabulary.py finds in each page, keyed by the SHA-256 of
+    the page text and the analyzer that tokenized it, so a page is only tokenized
+    once whatever volume it's loaded in.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS PageTokens (
+            text_hash BLOB PRIMARY KEY,
+            tokenizer TEXT,
+            tokens TEXT
+        )
+    """)
+
+
+def index_canonical_volumes(conn: sqlite3.Connection) -> None:
+    """Find the copies of a volume, to drop their mapping when it's deleted."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_canonical_volumes_canonical "
+        "ON CanonicalVolumes (canonical_volume_id)"
+    )
+
+
+def add_page_char_search(conn: sqlite3.Connection) -> None:
+    """
+    Index every character of the page text, for the searches of one or two
+    characters, e.g. a single kanji or a two-kanji compound, which the trigram
+    index can't match. The text is indexed with its characters separated by
+    spaces, one token each, and a phrase of characters matches them in a row.
+    The table is contentless, the text stays in Pages. catch_up_char_search
+    fills it.
+    """
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS PagesCharSearch USING fts5 (
+            text,
+            content = '',
+            tokenize = 'unicode61'
+        )
+    """)
+
+
+def add_page_joiners(conn: sqlite3.Connection) -> None:
+    """
+    Count the full stops the reader puts between the lines of each page, which
+    transform.py leaves out of the character counts. They can only be counted from
+    the volume files, so the fingerprints are cleared and the next incremental
+    load parses every volume again.
+    """
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE Pages ADD COLUMN joiners INTEGER")
+    cur.execute("UPDATE Volumes SET file_mtime = NULL, file_hash = NULL")
+    if has_pages(conn):
+        logging.warning(
+            "The next reader.py --incremental parses every volume again to "
+            "count their line separators"
+        )
+
+
+def drop_char_search_triggers(conn: sqlite3.Connection) -> None:
+    """
+    PagesCharSearch was kept in sync by triggers calling spaced, a Python function,
+    and other clients couldn't write Pages anymore. The reader writes it instead.
+    """
+    for trigger in (
+        "pages_char_search_insert",
+        "pages_char_search_delete",
+        "pages_char_search_update",
+    ):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+
+# Applied in order, the database's user_version is the number of applied migrations
+MIGRATIONS = [
+    add_volume_fingerprints,
+    add_titles,
+    add_page_search,
+    add_transform_tables,
+    add_page_stats,
+    add_title_variants,
+    add_volume_dedup,
+    add_page_tokens,
+    index_canonical_volumes,
+    add_page_char_search,
+    add_page_joiners,
+    drop_char_search_triggers,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """Upgrade an existing database to the current schema in place."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Applying migration {number}: {migration.__name__}")
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+
+
+def create_indexes(conn: sqlite3.Connection) -> None:
+    """Create the secondary indexes used by the analytics queries."""
+    cur = conn.cursor()
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_pages_volume_page ON Pages (volume_id, page_number)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_volumes_title_volume ON Volumes (title_uuid, volume_number)"
+    )
+    conn.commit()
+
+
+def drop_indexes(conn: sqlite3.Connection) -> None:
+    """Drop the secondary indexes, so a bulk load doesn't maintain them row by row."""
+    cur = conn.cursor()
+    cur.execute("DROP INDEX IF EXISTS idx_pages_volume_page")
+    cur.execute("DROP INDEX IF EXISTS idx_volumes_title_volume")
+    conn.commit()
+
+
+SEARCH_TRIGGERS = [
+    "pages_search_insert",
+    "pages_search_delete",
+    "pages_search_update",
+]
+
+
+def ensure_search_triggers(conn: sqlite3.Connection) -> None:
+    """
+    A bulk load drops the search triggers until it's done, after a crash the
+    search index is missing the pages loaded since. Rebuild it when any trigger
+    is missing.
+    """
+    existing = {
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+        )
+    }
+    if existing.issuperset(SEARCH_TRIGGERS):
+        return
+    if existing.intersection(SEARCH_TRIGGERS) or has_pages(conn):
+        logging.warning("Search triggers are missing, rebuilding the search indexes")
+    rebuild_search_index(conn)
+    create_search_triggers(conn)
+
+
+def has_pages(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM Pages LIMIT 1").fetchone() is not None
+
+
+def create_search_triggers(conn: sqlite3.Connection) -> None:
+    """Keep PagesSearch in sync with every write to Pages."""
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS pages_search_insert AFTER INSERT ON Pages BEGIN
+            INSERT INTO PagesSearch (rowid, text) VALUES (new.id, new.text);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS pages_search_delete AFTER DELETE ON Pages BEGIN
+            INSERT INTO PagesSearch (PagesSearch, rowid, text)
+            VALUES ('delete', old.id, old.text);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS pages_search_update AFTER UPDATE ON Pages BEGIN
+            INSERT INTO PagesSearch (PagesSearch, rowid, text)
+            VALUES ('delete', old.id, old.text);
+            INSERT INTO PagesSearch (rowid, text) VALUES (new.id, new.text);
+        END
+    """)
+    conn.commit()
+
+
+def drop_search_triggers(conn: sqlite3.Connection) -> None:
+    """
+    Stop indexing page by page during a bulk load, rebuild_search_index catches
+    up in one pass afterwards.
+    """
+    cur = conn.cursor()
+    for trigger in SEARCH_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.commit()
+
+
+def rebuild_search_index(conn: sqlite3.Connection) -> None:
+    """Re-index the text of every page from scratch."""
+    conn.execute("INSERT INTO PagesSearch (PagesSearch) VALUES ('rebuild')")
+    # A contentless table can't be rebuilt from its content, it's refilled
+    has_char_search = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'PagesCharSearch'"
+    ).fetchone()
+    if has_char_search:
+        conn.execute("INSERT INTO PagesCharSearch (PagesCharSearch) VALUES ('delete-all')")
+        catch_up_char_search(conn)
+    conn.commit()
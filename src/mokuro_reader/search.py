@@ -0,0 +1,101 @@
+import argparse
+import sqlite3
+from typing import List
+
+from schema import spaced
+
+# The trigram index can't match anything shorter than a trigram, shorter queries
+# are answered by the character index
+MIN_MATCH_LENGTH = 3
+SNIPPET_LENGTH = 24
+# Volumes that are a copy of another one, e.g. another scan, aren't searched so
+# their pages don't show up twice
+COPIES_QUERY = """
+    SELECT cv.volume_id FROM CanonicalVolumes cv
+    INNER JOIN Volumes canonical ON canonical.id = cv.canonical_volume_id
+    WHERE cv.canonical_volume_id != cv.volume_id
+"""
+
+
+def quote_phrase(query: str) -> str:
+    """Quote a query as an FTS5 phrase, so its characters aren't read as syntax."""
+    return '"' + query.replace('"', '""') + '"'
+
+
+def search_pages(conn: sqlite3.Connection, query: str, limit: int = 20) -> List[dict]:
+    """
+    Find the pages containing a phrase, best matches first.
+    Returns the title, volume_number and page_number of each page along with a
+    snippet of the text around the match (highlighted with 【】) and its rank,
+    lower ranks being better matches.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    if len(query) >= MIN_MATCH_LENGTH:
+        cur = conn.execute(
+            f"""
+            SELECT t.title, v.volume_number, p.page_number,
+                snippet(PagesSearch, 0, '【', '】', '…', ?) AS snippet,
+                s.rank
+            FROM PagesSearch s
+            INNER JOIN Pages p ON p.id = s.rowid
+            INNER JOIN Volumes v ON v.id = p.volume_id
+            INNER JOIN Titles t ON t.title_uuid = v.title_uuid
+            WHERE PagesSearch MATCH ? AND v.id NOT IN ({COPIES_QUERY})
+            ORDER BY s.rank
+            LIMIT ?
+        """,
+            (SNIPPET_LENGTH, quote_phrase(query), limit),
+        )
+    else:
+        # One or two characters, e.g. a single kanji or a two-kanji compound: the
+        # character index matches them as a phrase of single-character tokens.
+        # Punctuation isn't indexed, so the phrase can match across it, instr keeps
+        # the exact matches. The index doesn't store the text, the snippet is cut
+        # around the first occurrence
+        cur = conn.execute(
+            f"""
+            SELECT t.title, v.volume_number, p.page_number,
+                '…' || substr(
+                    p.text, max(instr(p.text, :query) - :context, 1),
+                    2 * :context + length(:query)
+                ) || '…' AS snippet,
+                s.rank
+            FROM PagesCharSearch s
+            INNER JOIN Pages p ON p.id = s.rowid
+            INNER JOIN Volumes v ON v.id = p.volume_id
+            INNER JOIN Titles t ON t.title_uuid = v.title_uuid
+            WHERE PagesCharSearch MATCH :phrase AND instr(p.text, :query) > 0
+                AND v.id NOT IN ({COPIES_QUERY})
+            ORDER BY s.rank
+            LIMIT :limit
+        """,
+            {
+                "query": query,
+                "context": SNIPPET_LENGTH // 2,
+                "phrase": quote_phrase(spaced(query)),
+                "limit": limit,
+            },
+        )
+    columns = [column[0] for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search the text of every page.")
+    parser.add_argument("query", help="Phrase or kanji compound to look for")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--db", default="manga_ocr.db")
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        for result in search_pages(conn, args.query, args.limit):
+            print(
+                f"{result['title']} vol. {result['volume_number']} "
+                f"p. {result['page_number']}: {result['snippet']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
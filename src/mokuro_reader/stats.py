@@ -0,0 +1,101 @@
+import unicodedata
+from typing import Sequence, Tuple
+
+import numpy as np
+
+# Character categories, the columns of the histograms
+OTHER, KANJI, HIRAGANA, KATAKANA, PUNCTUATION, SEPARATOR = range(6)
+CATEGORIES = ["other", "kanji", "hiragana", "katakana", "punctuation", "separator"]
+
+# Kanji are counted per code point over this span, which covers
+#   - Extension A: U+3400 to U+4DBF
+#   - CJK Unified Ideographs: U+4E00 to U+9FFF
+KANJI_FIRST = 0x3400
+KANJI_LAST = 0x9FFF
+KANJI_SPAN = KANJI_LAST - KANJI_FIRST + 1
+
+
+def build_category_table() -> np.ndarray:
+    """Map every code point of the Basic Multilingual Plane to its category."""
+    table = np.full(0x10000, OTHER, dtype=np.uint8)
+    for code_point in range(0x10000):
+        category = unicodedata.category(chr(code_point))
+        if category[0] == "P":
+            table[code_point] = PUNCTUATION
+        elif category[0] == "Z" or category == "Cc":
+            table[code_point] = SEPARATOR
+    kanji = np.zeros(0x10000, dtype=bool)
+    kanji[0x3400:0x4DC0] = True
+    kanji[0x4E00:0xA000] = True
+    hiragana = np.zeros(0x10000, dtype=bool)
+    hiragana[0x3041:0x30A0] = True
+    katakana = np.zeros(0x10000, dtype=bool)
+    katakana[0x30A1:0x3100] = True
+    katakana[0x31F0:0x3200] = True
+    katakana[0xFF66:0xFFA0] = True
+    # Punctuation inside the kana blocks, like ・ or ゠, stays punctuation
+    letters = table != PUNCTUATION
+    table[kanji] = KANJI
+    table[hiragana & letters] = HIRAGANA
+    table[katakana & letters] = KATAKANA
+    return table
+
+
+CATEGORY_TABLE = build_category_table()
+
+
+def encode(texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode texts as a single array of code points. Returns the code points and the
+    offsets of each text, text i being code_points[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+    code_points = np.frombuffer(
+        "".join(texts).encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+    )
+    return code_points, offsets
+
+
+def categorize(code_points: np.ndarray) -> np.ndarray:
+    """Return the category of each code point, outside of the BMP is OTHER."""
+    categories = CATEGORY_TABLE[np.minimum(code_points, 0xFFFF)]
+    categories[code_points > 0xFFFF] = OTHER
+    return categories
+
+
+def category_histograms(code_points: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Count the characters of each category per text, one row per text."""
+    num_texts = len(offsets) - 1
+    text_index = np.repeat(np.arange(num_texts), np.diff(offsets))
+    cells = text_index * len(CATEGORIES) + categorize(code_points)
+    return np.bincount(cells, minlength=num_texts * len(CATEGORIES)).reshape(
+        num_texts, len(CATEGORIES)
+    )
+
+
+def kanji_histogram(code_points: np.ndarray) -> np.ndarray:
+    """Count each kanji, index i of the result is the code point KANJI_FIRST + i."""
+    kanji = code_points[CATEGORY_TABLE[np.minimum(code_points, 0xFFFF)] == KANJI]
+    return np.bincount(kanji - KANJI_FIRST, minlength=KANJI_SPAN)
+
+
+def character_count(histograms: np.ndarray) -> np.ndarray:
+    """Number of characters, leaving out whitespace and line breaks."""
+    return histograms.sum(axis=-1) - histograms[..., SEPARATOR]
+
+
+def new_kanji_per_text(
+    code_points: np.ndarray, offsets: np.ndarray, seen: np.ndarray
+) -> np.ndarray:
+    """
+    Count the kanji each text uses for the first time, not counting those already
+    marked in seen, a boolean array over the kanji span. Marks the new kanji as seen.
+    """
+    positions = np.flatnonzero(categorize(code_points) == KANJI)
+    columns, first = np.unique(code_points[positions] - KANJI_FIRST, return_index=True)
+    new = ~seen[columns]
+    seen[columns[new]] = True
+    # The text of a position is the last one starting at or before it
+    texts = np.searchsorted(offsets, positions[first[new]], side="right") - 1
+    return np.bincount(texts, minlength=len(offsets) - 1)
@@ -1,75 +1,515 @@
 # %%
+import argparse
 import pandas as pd
 import sqlite3
 import logging
-import re
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+import stats
+from kanji_matrix import MATRIX_PATH, KanjiMatrix
+from rekey import rekey_enrichments
+from schema import create_tables
 
 # Read sqlite query results into a pandas DataFrame
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 
-def extract_kanji(text):
+DIM_MANGA_DTYPES = {
+    "clean_title": "string",
+    "title_uuid": "string",
+    "volume_count": "int32",
+    "page_count": "int32",
+    "num_of_unique_chrs": "int32",
+    "num_of_chrs": "int64",
+    "avg_chr_per_page": "float64",
+    "avg_chr_per_volume": "float64",
+    "num_of_kanji": "int64",
+    "num_of_hiragana": "int64",
+    "num_of_katakana": "int64",
+    "num_of_punctuation": "int64",
+    "num_of_other": "int64",
+}
+DIM_VOLUME_DTYPES = {
+    "title": "string",
+    "title_uuid": "string",
+    "volume_number": "int32",
+    "length": "int64",
+    "page_count": "int32",
+    "num_of_other": "int64",
+    "num_of_kanji": "int64",
+    "num_of_hiragana": "int64",
+    "num_of_katakana": "int64",
+    "num_of_punctuation": "int64",
+    "clean_title": "string",
+}
+
+# The general view's mart: one row per title with its AniList details, the genres
+# of each title, and sums and counts per year and per year and genre to average
+MART_TITLE_COLUMNS = [
+    "title_uuid",
+    "romanji_title",
+    "start_year",
+    "score",
+    "volume_count",
+    "page_count",
+    "num_of_unique_chrs",
+    "num_of_chrs",
+    "avg_chr_per_page",
+    "avg_chr_per_volume",
+]
+MART_MEASURES = ["avg_chr_per_volume", "avg_chr_per_page", "score", "num_of_unique_chrs"]
+# The tables of the general view, materialized by export_general_mart
+MART_TABLES = ["mart_title", "mart_title_genre", "mart_year", "mart_year_genre"]
+
+PAGE_STATS_COLUMNS = [
+    "title_uuid",
+    "page_index",
+    "volume_number",
+    "page_number",
+    "length",
+    "new_kanji",
+    "unique_kanji",
+]
+
+# The statistics of every title and volume with the canonical title they belong to
+TITLE_STATS_QUERY = """select s.*, tv.canonical_uuid
+    from TitleStats s
+    inner join TitleVariants tv on tv.title_uuid = s.title_uuid
+    order by s.title_uuid"""
+VOLUME_STATS_QUERY = """select s.*, tv.canonical_uuid
+    from VolumeStats s
+    inner join TitleVariants tv on tv.title_uuid = s.title_uuid
+    order by s.title_uuid, s.volume_number"""
+
+# The canonical title of every title, and whether it's the main upload of the
+# canonical title, the one with the most volumes that dim_manga is built from.
+# Uploads whose volumes are all copies have no statistics and are never the main one
+TITLE_VARIANTS_QUERY = """select tv.title_uuid, tv.canonical_uuid, tv.variant,
+        s.title_uuid is not null and row_number() over (
+            partition by tv.canonical_uuid
+            order by s.volume_count desc, tv.title_uuid
+        ) = 1 as main
+    from TitleVariants tv
+    left join TitleStats s on s.title_uuid = tv.title_uuid
+    order by tv.title_uuid"""
+
+PAGES_QUERY = """select v.title_uuid, t.title, v.volume_number, v.volume, p.page_number,
+            coalesce(p.joiners, 0), p.text
+        from titles t
+        inner join volumes v on v.title_uuid = t.title_uuid
+        inner join pages p on p.volume_id = v.id
+        where v.id not in (
+            select cv.volume_id from CanonicalVolumes cv
+            inner join Volumes canonical on canonical.id = cv.canonical_volume_id
+            where cv.canonical_volume_id != cv.volume_id
+        ){where}
+        order by v.title_uuid, v.volume_number, v.id, p.page_number;"""
+
+
+def iter_pages(
+    con: sqlite3.Connection, title_uuids: Optional[Set[str]] = None
+) -> Iterator[Tuple]:
+    """
+    Stream every page as (title_uuid, title, volume_number, volume, page_number,
+    joiners, text), ordered by title, volume and page. joiners is the number of
+    full stops the reader put between the lines of the page. The order follows the Volumes(title_uuid,
+    volume_number) and Pages(volume_id, page_number) indexes, so SQLite doesn't
+    have to sort. The volumes dedup.py found to be a copy of another volume that's
+    still loaded are skipped, so their content isn't counted twice.
+    When title_uuids is given, only the pages of those titles are read.
+    """
+    if title_uuids is None:
+        queries = [(PAGES_QUERY.format(where=""), ())]
+    else:
+        queries = [
+            (PAGES_QUERY.format(where=" and v.title_uuid = ?"), (title_uuid,))
+            for title_uuid in sorted(title_uuids)
+        ]
+    for query, parameters in queries:
+        cur = con.execute(query, parameters)
+        cur.arraysize = 1000
+        while rows := cur.fetchmany():
+            yield from rows
+
+
+def category_columns(histogram: np.ndarray) -> dict:
+    """Name the per-category counts of a histogram row, e.g. num_of_kanji."""
+    return {
+        f"num_of_{category}": int(histogram[index])
+        for index, category in enumerate(stats.CATEGORIES)
+        if index != stats.SEPARATOR
+    }
+
+
+def aggregate(
+    con: sqlite3.Connection, title_uuids: Optional[Set[str]] = None
+) -> Iterator[Tuple[dict, List[dict], List[np.ndarray], List[Tuple]]]:
+    """
+    Walk the pages title by title and yield, for each title, its row, the rows of
+    its volumes, the page statistics and the kanji counts of each volume.
+    Character statistics are computed per volume with the vectorized engine in
+    stats.py and summed into running per-title totals, so at most one volume's
+    text is held in memory at a time.
+
+    Character counts are exact: whitespace and line breaks aren't counted, nor are
+    the 。 the reader puts between the lines of a block, and no separator is added
+    between pages.
+    """
+    pages = iter_pages(con, title_uuids)
+    for title_uuid, title_pages in groupby(pages, key=itemgetter(0)):
+        volumes = []
+        pages_stats = []
+        kanji_rows = []
+        title = None
+        volume_names = set()
+        title_histogram = np.zeros(len(stats.CATEGORIES), dtype=np.int64)
+        title_kanji = np.zeros(stats.KANJI_SPAN, dtype=np.int64)
+        seen_kanji = np.zeros(stats.KANJI_SPAN, dtype=bool)
+        title_pages_count = 0
+        for volume_number, volume_pages in groupby(title_pages, key=itemgetter(2)):
+            texts = []
+            page_numbers = []
+            joiners = []
+            for page in volume_pages:
+                _, title, _, volume_name, page_number, joiner_count, text = page
+                volume_names.add(volume_name)
+                page_numbers.append(page_number)
+                joiners.append(joiner_count)
+                texts.append(text)
+            code_points, offsets = stats.encode(texts)
+            page_histograms = stats.category_histograms(code_points, offsets)
+            page_histograms[:, stats.PUNCTUATION] -= joiners
+            volume_histogram = page_histograms.sum(axis=0)
+            new_kanji = stats.new_kanji_per_text(code_points, offsets, seen_kanji)
+            page_index = title_pages_count + np.arange(1, len(texts) + 1)
+            pages_stats.append(
+                np.rec.fromarrays(
+                    [
+                        np.full(len(texts), title_uuid, dtype=object),
+                        page_index,
+                        np.full(len(texts), volume_number),
+                        np.array(page_numbers),
+                        stats.character_count(page_histograms),
+                        new_kanji,
+                        np.count_nonzero(title_kanji) + np.cumsum(new_kanji),
+                    ],
+                    names=PAGE_STATS_COLUMNS,
+                )
+            )
+            volumes.append(
+                {
+                    "title": title,
+                    "title_uuid": title_uuid,
+                    "volume_number": volume_number,
+                    "length": int(stats.character_count(volume_histogram)),
+                    "page_count": len(texts),
+                    **category_columns(volume_histogram),
+                }
+            )
+            volume_kanji = stats.kanji_histogram(code_points)
+            kanji_columns = np.flatnonzero(volume_kanji)
+            kanji_rows.append((kanji_columns, volume_kanji[kanji_columns]))
+            title_histogram += volume_histogram
+            title_kanji += volume_kanji
+            title_pages_count += len(texts)
+        title_row = {
+            "title": title,
+            "title_uuid": title_uuid,
+            "page_count": title_pages_count,
+            "volume_count": len(volume_names),
+            "num_of_unique_chrs": int(np.count_nonzero(title_kanji)),
+            "num_of_chrs": int(stats.character_count(title_histogram)),
+            **category_columns(title_histogram),
+        }
+        yield title_row, volumes, pages_stats, kanji_rows
+
+
+def delete_stats(
+    con: sqlite3.Connection, title_uuids: Optional[Set[str]] = None
+) -> None:
+    """
+    Delete the stored statistics of the given titles, or of every title when
+    title_uuids is None. Titles without pages anymore are simply not saved again.
+    """
+    cur = con.cursor()
+    for table in ("TitleStats", "VolumeStats", "PageStats"):
+        if title_uuids is None:
+            cur.execute(f"delete from {table}")
+        else:
+            cur.executemany(
+                f"delete from {table} where title_uuid = ?",
+                ((title_uuid,) for title_uuid in title_uuids),
+            )
+
+
+def save_stats(
+    con: sqlite3.Connection,
+    title: dict,
+    volumes: List[dict],
+    pages_stats: List[np.ndarray],
+) -> None:
+    """Insert the statistics of a title, its volumes and their pages."""
+    cur = con.cursor()
+    for volume_pages in pages_stats:
+        cur.executemany(
+            f"insert into PageStats ({', '.join(PAGE_STATS_COLUMNS)}) "
+            f"values ({', '.join('?' * len(PAGE_STATS_COLUMNS))})",
+            volume_pages.tolist(),
+        )
+    for table, rows in (("TitleStats", [title]), ("VolumeStats", volumes)):
+        columns = list(rows[0])
+        cur.executemany(
+            f"insert into {table} ({', '.join(columns)}) "
+            f"values ({', '.join(':' + column for column in columns)})",
+            rows,
+        )
+
+
+def build_stats(
+    con: sqlite3.Connection, title_uuids: Optional[Set[str]] = None
+) -> KanjiMatrix:
     """
-    Extracts all Kanji characters from the given text.
-    This function includes:
-      - Extension A: U+3400 to U+4DBF
-      - CJK Unified Ideographs: U+4E00 to U+9FFF
+    Replace the statistics of the given titles, or of every title, saving each
+    title as soon as it's aggregated so memory doesn't grow with the corpus.
+    Only the kanji counts of the volumes are kept, they're the returned matrix.
     """
-    # The regex finds any character in the specified Unicode ranges.
-    kanji_matches = re.findall(r"[\u3400-\u4DBF\u4E00-\u9FFF]", text)
-    kanji_matches_set = set(kanji_matches)
-    return kanji_matches_set
+    delete_stats(con, title_uuids)
+    keys = []
+    kanji_rows = []
+    title_count = 0
+    for title, volumes, pages_stats, volume_kanji in aggregate(con, title_uuids):
+        save_stats(con, title, volumes, pages_stats)
+        keys.extend(
+            (volume["title_uuid"], volume["volume_number"]) for volume in volumes
+        )
+        kanji_rows.extend(volume_kanji)
+        title_count += 1
+    logging.info(f"Aggregated {title_count} titles and {len(keys)} volumes")
+    return KanjiMatrix.from_rows(keys, kanji_rows)
+
 
+def get_state(con: sqlite3.Connection, key: str):
+    row = con.execute("select value from TransformState where key = ?", (key,)).fetchone()
+    return row[0] if row else None
 
-with sqlite3.connect("manga_ocr.db") as con:
-    logging.info("Connected to the sqlite db")
-    pages = pd.read_sql_query(
-        """select title, title_uuid, string_agg(text, '。') as text, count(p.page_number) as page_count, count(distinct v.volume) as volume_count from pages p 
-        inner join volumes v on v.id = p.volume_id 
-        group by v.title, title_uuid;""",
-        con,
+
+def set_state(con: sqlite3.Connection, key: str, value) -> None:
+    con.execute(
+        "insert or replace into TransformState (key, value) values (?, ?)", (key, value)
     )
-    logging.info("Successfully run the unified_view query")
 
-    pages["unique_chrs"] = pages["text"].apply(extract_kanji)
-    pages["num_of_unique_chrs"] = pages["unique_chrs"].str.len()
-    pages["unique_chrs"] = pages["unique_chrs"].apply(lambda x: ", ".join(x))
-    pages["num_of_chrs"] = pages["text"].str.len()
+
+def changed_titles(con: sqlite3.Connection, last_change: int) -> Set[str]:
+    """The titles whose volumes were added, removed or renumbered since a change."""
+    cur = con.execute(
+        "select distinct title_uuid from VolumeChanges where id > ?", (last_change,)
+    )
+    return {title_uuid for (title_uuid,) in cur}
+
+
+def build_dim_manga(titles: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per canonical title, from the variant with the most volumes. The
+    title_uuid of the dimension is the canonical one, which doesn't depend on
+    which uploads of the title are loaded.
+    """
+    pages = titles.copy()
     pages["pages_per_volume"] = pages["page_count"] / pages["volume_count"]
     pages["avg_chr_per_page"] = pages["num_of_chrs"] / pages["page_count"]
     pages["avg_chr_per_volume"] = pages["num_of_chrs"] / pages["volume_count"]
     pages["clean_title"] = pages["title"].str.replace("(Upscaled)", "").str.strip()
     pages = pages.sort_values(
-        by=["clean_title", "volume_count"], ascending=[True, False]
+        by=["canonical_uuid", "volume_count", "title_uuid"],
+        ascending=[True, False, True],
     )
-    # pages[pages['clean_title'].duplicated()].sort_values(by='title')
-    pages_dedup = pages.drop_duplicates(subset=["clean_title"])
-    logging.info("Completed cleaning the data")
-    cols = [
-        "clean_title",
-        "title_uuid",
-        "volume_count",
-        "page_count",
-        "num_of_unique_chrs",
-        "num_of_chrs",
-        "avg_chr_per_page",
-        "avg_chr_per_volume",
-    ]
-    pages_dedup[cols].to_csv("data/dim_manga.csv", index=False)
-    logging.info("Extracted the data to the data folder")
-
-    volumes = pd.read_sql_query(
-        """select title, title_uuid, v.volume_number, length(string_agg(text, '。')) as length, count(p.page_number) as page_count from pages p 
-        inner join volumes v on v.id = p.volume_id 
-        group by v.title, title_uuid, volume_number;""",
-        con,
-    )
-    logging.info("Successfully run the volume query")
+    pages_dedup = pages.drop_duplicates(subset=["canonical_uuid"])
+    pages_dedup = pages_dedup.assign(title_uuid=pages_dedup["canonical_uuid"])
+    pages_dedup = pages_dedup.sort_values(by=["clean_title", "title_uuid"])
+    return pages_dedup[list(DIM_MANGA_DTYPES)].astype(DIM_MANGA_DTYPES)
+
+
+def build_dim_volume(volumes: pd.DataFrame) -> pd.DataFrame:
+    """One row per volume number of each canonical title, keyed like dim_manga."""
+    volumes = volumes.copy()
     volumes["clean_title"] = volumes["title"].str.replace("(Upscaled)", "").str.strip()
     volumes = volumes.sort_values(
-        by=["clean_title", "volume_number", "page_count", "length"],
-        ascending=[True, True, True, True],
+        by=["canonical_uuid", "volume_number", "page_count", "length", "title_uuid"],
     )
-    volumes_dedup = volumes.drop_duplicates(subset=["clean_title", "volume_number"])
-    volumes_dedup.to_csv("data/dim_volume.csv", index=False)
-    logging.info("Extracted the data to the data folder")
+    volumes_dedup = volumes.drop_duplicates(subset=["canonical_uuid", "volume_number"])
+    volumes_dedup = volumes_dedup.assign(title_uuid=volumes_dedup["canonical_uuid"])
+    volumes_dedup = volumes_dedup.sort_values(by=["clean_title", "volume_number"])
+    return volumes_dedup[list(DIM_VOLUME_DTYPES)].astype(DIM_VOLUME_DTYPES)
+
+
+def export_table(df: pd.DataFrame, name: str) -> None:
+    """
+    Write a dimension table to the data folder, as CSV and as Parquet. The Parquet
+    copy keeps the column types and is what the app loads when it's present.
+    """
+    df.to_csv(f"data/{name}.csv", index=False)
+    df.to_parquet(f"data/{name}.parquet", index=False)
+    logging.info(f"Extracted {name} to the data folder")
+
+
+def remove_table(name: str) -> None:
+    """Remove both copies of a table from the data folder, if it was exported."""
+    for suffix in (".csv", ".parquet"):
+        Path(f"data/{name}{suffix}").unlink(missing_ok=True)
+
+
+def read_table(name: str, fallback: Path) -> Optional[pd.DataFrame]:
+    """
+    Read a table from the data folder, preferring its Parquet copy over the
+    CSV or JSON Lines fallback. Returns None when neither exists.
+    """
+    parquet_path = Path(f"data/{name}.parquet")
+    if parquet_path.exists():
+        return pd.read_parquet(parquet_path)
+    if not fallback.exists():
+        return None
+    if fallback.suffix == ".jsonl":
+        return pd.read_json(fallback, lines=True)
+    return pd.read_csv(fallback)
+
+
+def build_mart_titles(dim_manga: pd.DataFrame, anilist: pd.DataFrame) -> pd.DataFrame:
+    """One row per title with a known publication year, with its details and stats."""
+    titles = anilist.drop_duplicates(subset=["title_uuid"]).merge(
+        dim_manga, on="title_uuid", how="inner"
+    )
+    titles["start_year"] = titles["start_year"].fillna(0).astype(int)
+    titles = titles[titles["start_year"] > 0]
+    return titles.sort_values(by=["start_year", "title_uuid"]).reset_index(drop=True)
+
+
+def build_mart_title_genres(
+    mart_titles: pd.DataFrame, anilist: pd.DataFrame
+) -> pd.DataFrame:
+    """The genres of each title of the mart, one row per title and genre."""
+    genres = (
+        anilist.drop_duplicates(subset=["title_uuid"])[["title_uuid", "genres"]]
+        .explode("genres")
+        .dropna()
+    )
+    return (
+        mart_titles[["title_uuid", "start_year"]]
+        .drop_duplicates()
+        .merge(genres, on="title_uuid")
+    )
+
+
+def rollup(facts: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    """
+    Sum and count the measures per group. A title is in a single year, so the sums
+    and counts of several years add up and the app gets the averages over any
+    range of years with another sum.
+    """
+    grouped = facts.groupby(keys)
+    sums = grouped[MART_MEASURES].agg(["sum", "count"])
+    sums.columns = [f"{measure}_{agg}" for measure, agg in sums.columns]
+    sums["title_count"] = grouped["title_uuid"].nunique()
+    return sums.reset_index()
+
+
+def export_general_mart(dim_manga: pd.DataFrame) -> None:
+    """
+    Materialize the tables of the general view, which needs the AniList details
+    of the titles. Until src/utils/anilist.py has fetched them, the tables of a
+    previous build are removed as they don't match dim_manga anymore.
+    """
+    anilist = read_table("anilist_data", Path("data/anilist_data.jsonl"))
+    if anilist is None:
+        logging.info("No AniList data yet, skipping the general view mart")
+        for name in MART_TABLES:
+            remove_table(name)
+        return
+    mart_titles = build_mart_titles(dim_manga, anilist)[MART_TITLE_COLUMNS]
+    mart_title_genres = build_mart_title_genres(mart_titles, anilist)
+    mart_year_genres = mart_title_genres.merge(
+        mart_titles[["title_uuid", *MART_MEASURES]], on="title_uuid"
+    )
+    export_table(mart_titles, "mart_title")
+    export_table(mart_title_genres, "mart_title_genre")
+    export_table(rollup(mart_titles, ["start_year"]), "mart_year")
+    export_table(rollup(mart_year_genres, ["start_year", "genres"]), "mart_year_genre")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build the dimension tables.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only recompute the titles whose volumes changed since the last build",
+    )
+    parser.add_argument(
+        "--mart-only",
+        action="store_true",
+        help="Only rebuild the general view mart from the existing dim_manga table, "
+        "e.g. after fetching the AniList data",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.mart_only:
+        dim_manga = read_table("dim_manga", Path("data/dim_manga.csv"))
+        variants = read_table("title_variants", Path("data/title_variants.csv"))
+        if variants is not None:
+            rekey_enrichments(variants, dim_manga)
+        export_general_mart(dim_manga)
+        return
+    with sqlite3.connect("manga_ocr.db") as con:
+        logging.info("Connected to the sqlite db")
+        # Upgrades databases created before the Titles table and indexes existed
+        create_tables(con)
+        last_change = get_state(con, "last_change_id")
+        latest_change = con.execute(
+            "select coalesce(max(id), 0) from VolumeChanges"
+        ).fetchone()[0]
+
+        title_uuids = None
+        if args.incremental and last_change is not None and MATRIX_PATH.exists():
+            title_uuids = changed_titles(con, last_change)
+            logging.info(f"{len(title_uuids)} titles changed since the last build")
+        elif args.incremental:
+            logging.info("No previous build to update, rebuilding everything")
+
+        kanji_matrix = build_stats(con, title_uuids)
+        if title_uuids is not None:
+            kanji_matrix = KanjiMatrix.load().replace_titles(title_uuids, kanji_matrix)
+
+        # The dimension tables are rebuilt from the stored statistics of every
+        # title, which is cheap: one row per title and per volume
+        title_stats = pd.read_sql_query(TITLE_STATS_QUERY, con)
+        volume_stats = pd.read_sql_query(VOLUME_STATS_QUERY, con)
+        variants = pd.read_sql_query(TITLE_VARIANTS_QUERY, con).astype({"main": bool})
+        dim_manga = build_dim_manga(title_stats)
+        # Before dim_manga is replaced, its keys are needed to rekey the records
+        rekey_enrichments(variants, read_table("dim_manga", Path("data/dim_manga.csv")))
+        export_table(dim_manga, "dim_manga")
+        export_table(build_dim_volume(volume_stats), "dim_volume")
+        # Maps the title_uuid of the statistics and the kanji matrix rows, one per
+        # upload, to the canonical one of the dimension tables
+        export_table(variants, "title_variants")
+        kanji_matrix = kanji_matrix.with_variants(
+            dict(zip(variants["title_uuid"], variants["canonical_uuid"])),
+            set(variants.loc[variants["main"], "title_uuid"]),
+        )
+        kanji_matrix.save()
+        logging.info(f"Saved the {kanji_matrix.shape} kanji matrix to the data folder")
+        export_general_mart(dim_manga)
+
+        # Only record the build once its outputs are written
+        set_state(con, "last_change_id", latest_change)
+        con.execute("delete from VolumeChanges where id <= ?", (latest_change,))
+        con.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterator, List, Set, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from schema import create_tables
+from transform import TITLE_VARIANTS_QUERY, export_table, iter_pages
+
+try:
+    import fugashi
+except ImportError:  # optional, see the "nlp" extra
+    fugashi = None
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+# Pages are sent to the workers in batches, with at most PREFETCH_PER_WORKER
+# batches per worker in flight
+BATCH_PAGES = 256
+PREFETCH_PER_WORKER = 4
+# Frequency rows are written to Parquet in row groups of this many rows
+ROW_GROUP_SIZE = 500_000
+# Punctuation, symbols and whitespace aren't words
+SKIPPED_POS = {"補助記号", "記号", "空白"}
+
+# The main upload of every canonical title, the one dim_manga is built from
+MAIN_VARIANTS_QUERY = f"""select title_uuid, canonical_uuid
+    from ({TITLE_VARIANTS_QUERY})
+    where main"""
+
+VOLUME_FREQUENCY_SCHEMA = pa.schema(
+    [("title_uuid", pa.string()), ("volume_number", pa.int32())]
+    + [("word", pa.string()), ("lemma", pa.string()), ("pos", pa.string())]
+    + [("count", pa.int64())]
+)
+TITLE_FREQUENCY_SCHEMA = pa.schema(
+    [field for field in VOLUME_FREQUENCY_SCHEMA if field.name != "volume_number"]
+)
+
+tagger = None
+
+
+def tokenizer_name() -> str:
+    """
+    The analyzer and dictionary versions, cached tokens are only reused for the
+    same ones.
+    """
+    return ", ".join(
+        f"{name} {metadata.version(name)}" for name in ("fugashi", "unidic-lite")
+    )
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+
+def init_worker() -> None:
+    global tagger
+    tagger = fugashi.Tagger()
+
+
+def tokenize(texts: List[str]) -> List[str]:
+    """
+    Count the words of each text, as JSON lists of [word, lemma, pos, count]. The
+    lemma is the dictionary form as written, e.g. 食べ gives 食べる, pos is the
+    coarse part of speech. This runs in the worker processes.
+    """
+    results = []
+    for text in texts:
+        counts = Counter()
+        for word in tagger(text):
+            pos = word.feature.pos1
+            if not word.surface or pos in SKIPPED_POS:
+                continue
+            lemma = word.feature.orthBase
+            if not lemma or lemma == "*":
+                lemma = word.surface
+            counts[word.surface, lemma, pos or ""] += 1
+        results.append(
+            json.dumps(
+                [[*key, count] for key, count in counts.items()], ensure_ascii=False
+            )
+        )
+    return results
+
+
+def cached_hashes(con: sqlite3.Connection, tokenizer: str) -> Set[bytes]:
+    return {
+        row[0]
+        for row in con.execute(
+            "select text_hash from PageTokens where tokenizer = ?", (tokenizer,)
+        )
+    }
+
+
+def uncached_batches(
+    pages: Iterator[Tuple], cached: Set[bytes]
+) -> Iterator[Tuple[List[bytes], List[str]]]:
+    """The texts that have no cached tokens, once each, in batches of BATCH_PAGES."""
+    hashes, texts = [], []
+    for *_, text in pages:
+        key = text_hash(text)
+        if key in cached:
+            continue
+        cached.add(key)
+        hashes.append(key)
+        texts.append(text)
+        if len(texts) >= BATCH_PAGES:
+            yield hashes, texts
+            hashes, texts = [], []
+    if texts:
+        yield hashes, texts
+
+
+def tokenize_batches(
+    batches: Iterator[Tuple[List[bytes], List[str]]], workers: int
+) -> Iterator[Tuple[List[bytes], List[str]]]:
+    """
+    Tokenize the batches in a process pool, yielding them in their original order
+    with a bounded number in flight, like reader.load_volumes.
+    """
+    if workers <= 1:
+        init_worker()
+        for hashes, texts in batches:
+            yield hashes, tokenize(texts)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        pending = deque()
+        for hashes, texts in batches:
+            pending.append((hashes, executor.submit(tokenize, texts)))
+            if len(pending) >= workers * PREFETCH_PER_WORKER:
+                hashes, future = pending.popleft()
+                yield hashes, future.result()
+        while pending:
+            hashes, future = pending.popleft()
+            yield hashes, future.result()
+
+
+def update_cache(
+    con: sqlite3.Connection, title_uuids: Set[str], tokenizer: str, workers: int
+) -> None:
+    """Tokenize the pages of the titles whose text isn't in the cache yet."""
+    cached = cached_hashes(con, tokenizer)
+    batches = uncached_batches(iter_pages(con, title_uuids), cached)
+    tokenized = 0
+    for batch, (hashes, results) in enumerate(tokenize_batches(batches, workers), 1):
+        con.executemany(
+            "insert or replace into PageTokens (text_hash, tokenizer, tokens) "
+            "values (?, ?, ?)",
+            ((key, tokenizer, tokens) for key, tokens in zip(hashes, results)),
+        )
+        con.commit()
+        tokenized += len(hashes)
+        if batch % 40 == 0:
+            logging.info(f"Tokenized {tokenized} pages")
+    logging.info(f"Tokenized {tokenized} pages that weren't cached")
+
+
+class FrequencyWriter:
+    """Buffers frequency rows and writes them to a Parquet file by row groups."""
+
+    def __init__(self, path: str, schema: pa.Schema):
+        self.schema = schema
+        self.writer = pq.ParquetWriter(path, schema)
+        self.columns: Dict[str, list] = {name: [] for name in schema.names}
+        self.rows = 0
+
+    def add(self, keys: dict, counts: Counter) -> None:
+        for name, value in keys.items():
+            self.columns[name].extend([value] * len(counts))
+        for (word, lemma, pos), count in counts.items():
+            self.columns["word"].append(word)
+            self.columns["lemma"].append(lemma)
+            self.columns["pos"].append(pos)
+            self.columns["count"].append(count)
+        self.rows += len(counts)
+        if self.rows >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.rows:
+            self.writer.write_table(pa.table(self.columns, schema=self.schema))
+        self.columns = {name: [] for name in self.schema.names}
+        self.rows = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+
+def summary(keys: dict, counts: Counter) -> dict:
+    return {
+        **keys,
+        "num_of_words": sum(counts.values()),
+        "num_of_unique_words": len(counts),
+        "num_of_unique_lemmas": len({(lemma, pos) for _, lemma, pos in counts}),
+    }
+
+
+def page_counts(con: sqlite3.Connection, text: str, tokenizer: str) -> Counter:
+    (tokens,) = con.execute(
+        "select tokens from PageTokens where text_hash = ? and tokenizer = ?",
+        (text_hash(text), tokenizer),
+    ).fetchone()
+    return Counter(
+        {(word, lemma, pos): count for word, lemma, pos, count in json.loads(tokens)}
+    )
+
+
+def build_frequencies(
+    con: sqlite3.Connection, canonical_uuids: Dict[str, str], tokenizer: str
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Sum the cached word counts of the pages per volume and per title, writing the
+    frequency tables as they're built, so at most one title's counts are held in
+    memory. Titles are keyed by their canonical UUID, like dim_manga. Returns the
+    word and lemma counts of every volume and title.
+    """
+    volumes = []
+    titles = []
+    volume_writer = FrequencyWriter(
+        "data/word_frequency_volume.parquet", VOLUME_FREQUENCY_SCHEMA
+    )
+    title_writer = FrequencyWriter(
+        "data/word_frequency_title.parquet", TITLE_FREQUENCY_SCHEMA
+    )
+    try:
+        pages = iter_pages(con, set(canonical_uuids))
+        for title_uuid, title_pages in groupby(pages, key=itemgetter(0)):
+            canonical_uuid = canonical_uuids[title_uuid]
+            title_counts = Counter()
+            volume_count = 0
+            for volume_number, volume_pages in groupby(title_pages, key=itemgetter(2)):
+                volume_counts = Counter()
+                for *_, text in volume_pages:
+                    volume_counts.update(page_counts(con, text, tokenizer))
+                keys = {"title_uuid": canonical_uuid, "volume_number": volume_number}
+                volume_writer.add(keys, volume_counts)
+                volumes.append(summary(keys, volume_counts))
+                title_counts.update(volume_counts)
+                volume_count += 1
+            title_writer.add({"title_uuid": canonical_uuid}, title_counts)
+            titles.append(
+                summary(
+                    {"title_uuid": canonical_uuid, "volume_count": volume_count},
+                    title_counts,
+                )
+            )
+    finally:
+        volume_writer.close()
+        title_writer.close()
+    return pd.DataFrame(volumes), pd.DataFrame(titles)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Tokenize the pages and build the word frequency tables."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes tokenizing the pages (1 disables the pool)",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if fugashi is None:
+        raise SystemExit(
+            "vocabulary.py needs fugashi and unidic-lite, install the nlp extra"
+        )
+    tokenizer = tokenizer_name()
+    with sqlite3.connect("manga_ocr.db") as con:
+        create_tables(con)
+        canonical_uuids = dict(con.execute(MAIN_VARIANTS_QUERY).fetchall())
+        if not canonical_uuids:
+            logging.warning("No title statistics yet, run transform.py first")
+            return
+        logging.info(f"Tokenizing the pages of {len(canonical_uuids)} titles")
+        update_cache(con, set(canonical_uuids), tokenizer, args.workers)
+        volumes, titles = build_frequencies(con, canonical_uuids, tokenizer)
+    export_table(volumes, "vocabulary_volume")
+    export_table(titles, "vocabulary_title")
+    logging.info(
+        f"Counted {titles['num_of_words'].sum()} words in {len(volumes)} volumes"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from pathlib import Path
+from typing import Optional, Tuple
+
+import pandas as pd
+import streamlit as st
+
+DATA_DIR = Path("data")
+
+# The cached tables are shared by every session of the process. With copy-on-write
+# the frames handed to the views share their data with the cache, and a view that
+# modifies one gets its own copy instead of changing what other sessions see.
+# It's always on from pandas 3.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+
+def file_signature(path: Path) -> Optional[Tuple[int, int]]:
+    """The modification time and size of a file, None when it doesn't exist."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def read_cached(path: Path, signature: Tuple[int, int]) -> pd.DataFrame:
+    """
+    Read a file once per process. The signature is part of the cache key, so
+    rewriting the file, e.g. by running transform.py again, loads the new version.
+    """
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def read_table(name: str, fallback: str) -> pd.DataFrame:
+    """
+    Read data/<name>.parquet when it exists, it's typed and much faster to load.
+    Otherwise read the fallback, the CSV version of the table.
+    The frame is shared with the other sessions and must be treated as read-only.
+    """
+    for path in (DATA_DIR / f"{name}.parquet", DATA_DIR / fallback):
+        signature = file_signature(path)
+        if signature is not None:
+            return read_cached(path, signature).copy(deep=False)
+    raise FileNotFoundError(f"No {name} table in {DATA_DIR}")
+
+
+def load_dim_manga() -> pd.DataFrame:
+    return read_table("dim_manga", "dim_manga.csv")
+
+
+def load_dim_volume() -> pd.DataFrame:
+    return read_table("dim_volume", "dim_volume.csv")
+
+
+def load_mart(name: str) -> pd.DataFrame:
+    """Load one of the general view tables transform.py materializes, e.g. mart_year."""
+    return read_table(name, f"{name}.csv")
@@ -0,0 +1,164 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import pandas as pd
+import streamlit as st
+
+from data_loader import file_signature
+
+# The database built by src/mokuro_reader/reader.py. The app works without it,
+# the views only offer the drill-down when it's there.
+DB_PATH = Path(os.environ.get("MANGA_DB_PATH", "manga_ocr.db"))
+POOL_SIZE = 4
+
+TITLE_VOLUMES_QUERY = """select v.id as volume_id, v.volume_number, v.volume,
+        count(p.id) as page_count
+    from Volumes v
+    left join Pages p on p.volume_id = v.id
+    where v.title_uuid in (
+        select title_uuid from TitleVariants where canonical_uuid = ?
+    )
+    and v.id not in (
+        select cv.volume_id from CanonicalVolumes cv
+        inner join Volumes canonical on canonical.id = cv.canonical_volume_id
+        where cv.canonical_volume_id != cv.volume_id
+    )
+    group by v.id
+    order by v.volume_number, v.id"""
+# The length of a page as transform.py counts it, without the 。 the reader puts
+# between the lines of a block, the line breaks between blocks and whitespace
+PAGE_LENGTH = """length(replace(replace(replace(p.text, char(10), ''), ' ', ''),
+        char(12288), '')) - coalesce(p.joiners, 0)"""
+VOLUME_PAGES_QUERY = f"""select p.page_number, {PAGE_LENGTH} as length
+    from Pages p
+    where p.volume_id = ?
+    order by p.page_number"""
+# Pages loaded since transform.py last ran have no PageStats row yet
+VOLUME_PAGE_STATS_QUERY = f"""select p.page_number,
+        coalesce(ps.length, {PAGE_LENGTH}) as length
+    from Pages p
+    inner join Volumes v on v.id = p.volume_id
+    left join PageStats ps on ps.title_uuid = v.title_uuid
+        and ps.volume_number = v.volume_number
+        and ps.page_number = p.page_number
+    where p.volume_id = ?
+    group by p.id
+    order by p.page_number"""
+PAGE_TEXT_QUERY = """select text from Pages
+    where volume_id = ? and page_number = ?"""
+SERIES_PAGES_QUERY = """select page_index, volume_number, page_number, length,
+        new_kanji, unique_kanji
+    from PageStats
+    where title_uuid = (
+        select tv.title_uuid
+        from TitleVariants tv
+        inner join TitleStats s on s.title_uuid = tv.title_uuid
+        where tv.canonical_uuid = ?
+        order by s.volume_count desc, tv.title_uuid
+        limit 1
+    )
+    order by page_index"""
+TABLE_QUERY = "select name from sqlite_master where type = 'table' and name = ?"
+
+
+class ConnectionPool:
+    """
+    Read-only connections to the database, shared by the sessions of the process.
+    Streamlit runs every session in its own thread, each query borrows a connection
+    so concurrent sessions read in parallel, which WAL allows.
+    """
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            f"{self.path.resolve().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+            finally:
+                self.idle.put(conn)
+
+
+def database_available() -> bool:
+    return DB_PATH.exists()
+
+
+@st.cache_resource(show_spinner=False)
+def get_pool() -> ConnectionPool:
+    return ConnectionPool(DB_PATH, POOL_SIZE)
+
+
+def database_signature() -> Tuple[Optional[Tuple[int, int]], ...]:
+    """
+    Changes when the database is written to. Writes in WAL mode go to the -wal
+    file until a checkpoint, so its signature is part of it.
+    """
+    return file_signature(DB_PATH), file_signature(Path(f"{DB_PATH}-wal"))
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def cached_query(query: str, parameters: tuple, signature: tuple) -> pd.DataFrame:
+    """
+    Run a parametrized query, results are cached per query and parameters.
+    The signature of the database invalidates them when it's rebuilt.
+    """
+    with get_pool().connection() as conn:
+        return pd.read_sql_query(query, conn, params=parameters)
+
+
+def title_volumes(canonical_uuid: str) -> pd.DataFrame:
+    """
+    The volumes of every upload of a canonical title with their page counts,
+    in volume order, without the copies of another volume.
+    """
+    return cached_query(TITLE_VOLUMES_QUERY, (canonical_uuid,), database_signature())
+
+
+def volume_pages(volume_id: int) -> pd.DataFrame:
+    """
+    The number of characters of each page of a volume, from PageStats so they
+    match the series charts once transform.py ran.
+    """
+    query = VOLUME_PAGE_STATS_QUERY if has_table("PageStats") else VOLUME_PAGES_QUERY
+    return cached_query(query, (volume_id,), database_signature())
+
+
+def page_text(volume_id: int, page_number: int) -> str:
+    pages = cached_query(
+        PAGE_TEXT_QUERY, (volume_id, page_number), database_signature()
+    )
+    return pages["text"].iloc[0] if len(pages) else ""
+
+
+def has_table(name: str) -> bool:
+    """Whether the database has a table, e.g. PageStats once transform.py ran."""
+    return not cached_query(TABLE_QUERY, (name,), database_signature()).empty
+
+
+def series_pages(canonical_uuid: str) -> pd.DataFrame:
+    """
+    The statistics of every page of the main upload of a canonical title, the one
+    with the most volumes, numbered across its volumes.
+    """
+    return cached_query(SERIES_PAGES_QUERY, (canonical_uuid,), database_signature())
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+# Most points a chart gets, whatever the length of the series
+MAX_POINTS = 1000
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: pick threshold points that keep the visual
+    shape of the line. The first and last points are kept, the others are split
+    in buckets and each bucket keeps the point forming the largest triangle with
+    the point kept before it and the average of the next bucket.
+    Returns the indices of the points to keep.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+    return kept
+
+
+def downsample(df: pd.DataFrame, x: str, y: str, threshold: int = MAX_POINTS):
+    """The rows of df to chart y against x, at most threshold of them."""
+    return df.iloc[lttb(df[x].to_numpy(), df[y].to_numpy(), threshold)]
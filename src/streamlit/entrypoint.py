@@ -1,8 +1,8 @@
 import streamlit as st
-import pandas as pd
 from home_view import home_view
 from manga_view import manga_view
 from general_view import general_view
+from data_loader import load_dim_manga
 
 st.set_page_config(
     layout="wide", page_title="MangaDB - jpdb but for manga", page_icon="📖"
@@ -10,7 +10,7 @@ st.set_page_config(
 
 # Big title
 st.title("MangaDB - Stats on your favorite manga")
-manga_dim = pd.read_csv("data/dim_manga.csv")
+manga_dim = load_dim_manga()
 titles = manga_dim["clean_title"].unique().tolist()
 st.sidebar.metric("Number of titles in the dataset", len(titles))
 
@@ -1,82 +1,81 @@
 import streamlit as st
-import pandas as pd
 import altair as alt
+import pandas as pd
+from data_loader import load_mart
 
 
-def clean_data(df):
-    df["start_year"] = df["start_year"].fillna(0)
-    df["start_year"] = df["start_year"].astype(int)
-    return df[df["start_year"] > 0]
+MEASURES = ["avg_chr_per_volume", "avg_chr_per_page", "score", "num_of_unique_chrs"]
 
 
-def filter_data(df, years, genres):
-    if genres:
-        return df[
-            (df["start_year"] >= years[0])
-            & (df["start_year"] <= years[1])
-            & (df["genres"].isin(genres))
-        ]
+def in_years(df, years):
     return df[(df["start_year"] >= years[0]) & (df["start_year"] <= years[1])]
 
 
+def averages(rollup, key):
+    """Turn the sums and counts of a rollup into averages per key."""
+    totals = rollup.groupby(key).sum(numeric_only=True)
+    result = pd.DataFrame(
+        {
+            measure: totals[f"{measure}_sum"] / totals[f"{measure}_count"]
+            for measure in MEASURES
+        }
+    )
+    # Charted as the number of mangas
+    result["title_uuid"] = totals["title_count"]
+    return result.reset_index()
+
+
+def year_averages(years, genres):
+    if not genres:
+        return averages(in_years(load_mart("mart_year"), years), "start_year")
+    # A title with several of the selected genres counts once in its year
+    title_genres = in_years(load_mart("mart_title_genre"), years)
+    titles = load_mart("mart_title")
+    titles = titles[
+        titles["title_uuid"].isin(
+            title_genres.loc[title_genres["genres"].isin(genres), "title_uuid"]
+        )
+    ]
+    grouped = titles.groupby("start_year")
+    result = grouped[MEASURES].mean()
+    result["title_uuid"] = grouped["title_uuid"].nunique()
+    return result.reset_index()
+
+
+def genre_averages(years, genres):
+    year_genres = in_years(load_mart("mart_year_genre"), years)
+    if genres:
+        year_genres = year_genres[year_genres["genres"].isin(genres)]
+    return averages(year_genres.drop(columns="start_year"), "genres")
+
+
 def general_view():
     # Query the table
     st.header(
         "This page shows the average number of characters, unique number of Kanji across years & different genres."
     )
-    manga_dim = pd.read_csv("data/dim_manga.csv")
-    manga_details = pd.read_json("data/anilist_data.jsonl", lines=True)
-    merged_data = clean_data(manga_details.merge(manga_dim, how="inner")).explode(
-        "genres"
-    )
-    genres_df = merged_data[["title_uuid", "genres"]].explode("genres").dropna()
+    # The rollups are precomputed by transform.py, the view only slices them.
+    # They're missing until the AniList details of the titles are fetched.
+    try:
+        year_range = load_mart("mart_year")["start_year"]
+    except FileNotFoundError:
+        year_range = pd.Series(dtype="Int32")
+    if year_range.empty:
+        st.info(
+            "No title has its AniList details yet, run src/utils/anilist.py and "
+            "transform.py --mart-only."
+        )
+        return
     years = st.sidebar.slider(
         "Year of Publication",
-        merged_data["start_year"].min(),
-        merged_data["start_year"].max(),
+        int(year_range.min()),
+        int(year_range.max()),
         (2000, 2024),
     )
-    genres = st.sidebar.multiselect("Manga genre", genres_df["genres"].unique())
-    columns = [
-        "title_uuid",
-        "romanji_title",
-        "start_year",
-        "score",
-        "genres",
-        "volume_count",
-        "page_count",
-        "num_of_unique_chrs",
-        "num_of_chrs",
-        "avg_chr_per_page",
-        "avg_chr_per_volume",
-    ]
-    merged_data = merged_data[columns]
-    merged_data = filter_data(merged_data, years, genres)
-    chr_columns = [
-        "title_uuid",
-        "score",
-        "romanji_title",
-        "start_year",
-        "num_of_unique_chrs",
-        "num_of_chrs",
-        "avg_chr_per_page",
-        "avg_chr_per_volume",
-    ]
-    grp_year = (
-        merged_data[chr_columns]
-        .drop_duplicates()
-        .groupby("start_year")
-        .agg(
-            {
-                "avg_chr_per_volume": "mean",
-                "avg_chr_per_page": "mean",
-                "score": "mean",
-                "num_of_unique_chrs": "mean",
-                "title_uuid": "nunique",
-            }
-        )
-        .reset_index()
+    genres = st.sidebar.multiselect(
+        "Manga genre", sorted(load_mart("mart_year_genre")["genres"].unique())
     )
+    grp_year = year_averages(years, genres)
     col1, col2 = st.columns(2, vertical_alignment="bottom", border=True)
     col3, col4 = st.columns(2, vertical_alignment="bottom", border=True)
     with col1:
@@ -127,32 +126,7 @@ def general_view():
             )
         )
         st.altair_chart(avg_page_chart, use_container_width=True)
-    genres_columns = [
-        "title_uuid",
-        "genres",
-        "score",
-        "romanji_title",
-        "start_year",
-        "num_of_unique_chrs",
-        "num_of_chrs",
-        "avg_chr_per_page",
-        "avg_chr_per_volume",
-    ]
-    grp_genres = (
-        merged_data[genres_columns]
-        .drop_duplicates()
-        .groupby("genres")
-        .agg(
-            {
-                "avg_chr_per_volume": "mean",
-                "avg_chr_per_page": "mean",
-                "score": "mean",
-                "num_of_unique_chrs": "mean",
-                "title_uuid": "nunique",
-            }
-        )
-        .reset_index()
-    )
+    grp_genres = genre_averages(years, genres)
     with col3:
         st.markdown("#### Average characters per volume across genres")
         avg_page_chart = (
@@ -1,11 +1,11 @@
 import streamlit as st
-import pandas as pd
 import altair as alt
+from data_loader import load_dim_manga
 
 
 def home_view():
     # Query the table
-    manga_dim = pd.read_csv("data/dim_manga.csv")
+    manga_dim = load_dim_manga()
     st.write("## This page shows basic statistics on mangas")
 
     titles = manga_dim["clean_title"].unique().tolist()
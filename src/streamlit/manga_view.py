@@ -1,10 +1,102 @@
 import streamlit as st
-import pandas as pd
 import altair as alt
+import pandas as pd
+from data_loader import load_dim_volume
+from db_backend import (
+    database_available,
+    has_table,
+    page_text,
+    series_pages,
+    title_volumes,
+    volume_pages,
+)
+from downsample import downsample
+
+
+def page_line_chart(pages, column, title):
+    """A line of a page statistic across the series, downsampled to MAX_POINTS."""
+    return (
+        alt.Chart(downsample(pages, "page_index", column))
+        .mark_line()
+        .encode(
+            x=alt.X("page_index:Q", title="Page # in the series"),
+            y=alt.Y(f"{column}:Q", title=title),
+            tooltip=[
+                alt.Tooltip("volume_number:Q", title="Volume #"),
+                alt.Tooltip("page_number:Q", title="Page #"),
+                alt.Tooltip(f"{column}:Q", title=title, format=","),
+            ],
+        )
+    )
+
+
+def series_page_stats(filtered_manga):
+    """Page statistics across a whole series, computed by transform.py."""
+    pages = series_pages(filtered_manga["title_uuid"].iloc[0])
+    if pages.empty:
+        return
+    st.header("Across the series, page by page")
+    col1, col2 = st.columns(2, vertical_alignment="bottom", border=True)
+    with col1:
+        st.markdown("#### Characters per page")
+        st.altair_chart(
+            page_line_chart(pages, "length", "# of characters"),
+            use_container_width=True,
+        )
+    with col2:
+        st.markdown("#### New kanji per page")
+        st.altair_chart(
+            page_line_chart(pages, "new_kanji", "# of new kanji"),
+            use_container_width=True,
+        )
+    st.markdown("#### Unique kanji so far")
+    st.altair_chart(
+        page_line_chart(pages, "unique_kanji", "# of unique kanji"),
+        use_container_width=True,
+    )
+
+
+def volume_drill_down(filtered_manga):
+    """Page by page statistics of a volume, read from the database."""
+    volumes = pd.concat(
+        [title_volumes(title_uuid) for title_uuid in filtered_manga["title_uuid"].unique()]
+    )
+    if volumes.empty:
+        return
+    st.header("Characters per page")
+    volume = st.selectbox(
+        "Pick a volume",
+        volumes.itertuples(index=False),
+        format_func=lambda volume: volume.volume,
+        key="selected_volume",
+    )
+    pages = volume_pages(int(volume.volume_id))
+    if pages.empty:
+        return
+    page_chart = (
+        alt.Chart(pages)
+        .mark_bar()
+        .encode(
+            x=alt.X("page_number:Q", title="Page #"),
+            y=alt.Y("length:Q", title="# of characters"),
+            tooltip=[
+                alt.Tooltip("page_number:Q", title="Page #"),
+                alt.Tooltip("length:Q", title="# of characters", format=","),
+            ],
+        )
+    )
+    st.altair_chart(page_chart, use_container_width=True)
+    page_number = st.number_input(
+        "Page #",
+        min_value=int(pages["page_number"].min()),
+        max_value=int(pages["page_number"].max()),
+        key="selected_page",
+    )
+    st.text(page_text(int(volume.volume_id), int(page_number)))
 
 
 def manga_view():
-    volume_dim = pd.read_csv("data/dim_volume.csv")
+    volume_dim = load_dim_volume()
     st.write(
         "## This page shows in-depth statistics :tm: on selected manga and their volumes"
     )
@@ -28,3 +120,7 @@ def manga_view():
         )
     )
     st.altair_chart(bar_chart_chars)
+    if database_available():
+        if has_table("PageStats"):
+            series_page_stats(filtered_manga)
+        volume_drill_down(filtered_manga)
@@ -1,103 +1,367 @@
-import random
-import requests
-import pandas as pd
+import argparse
+import asyncio
 import json
+import logging
 import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import httpx
+import pandas as pd
 
+from http_cache import MISSING, ResponseCache, cache_key
+from records import fetched_titles
+from retry import MAX_ATTEMPTS, backoff, retry_after
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+INPUT_PATH = "data/temp.csv"
 OUTPUT_DATA = "data/anilist_data.jsonl"
+OUTPUT_PARQUET = "data/anilist_data.parquet"
+ANILIST_DTYPES = {
+    "title": "string",
+    "romanji_title": "string",
+    "jp_title": "string",
+    "english_title": "string",
+    "title_uuid": "string",
+    "start_year": "Int32",
+    "score": "Int32",
+}
 ANILIST_URL = "https://graphql.anilist.co"
-# session = requests.Session()
-df = pd.read_csv("data/temp.csv")
-# Here we define our query as a multi-line string
-ANILIST_QUERY = """
-query ($title: String) {
-  Media(search: $title, type: MANGA) {
-    id
-    title {
-      romaji
-      english
-      native
-    }
-    status
-    startDate{
-      day
-      month
-      year
-    }
-    chapters
-    volumes
-    description
-    genres
-    averageScore
-    coverImage {
-      large
-    }
+# Titles searched per request, each one is an aliased Media field of the query
+BATCH_SIZE = 10
+CONCURRENCY = 4
+# AniList allows 90 requests per minute, the responses tell the current limit
+RATE_LIMIT = 90
+BURST = 5
+
+MEDIA_FRAGMENT = """
+fragment manga on Media {
+  id
+  title {
+    romaji
+    english
+    native
+  }
+  status
+  startDate {
+    day
+    month
+    year
+  }
+  chapters
+  volumes
+  description
+  genres
+  averageScore
+  coverImage {
+    large
   }
 }
 """
-session = requests.Session()
 
 
-def fetch_json(title: str) -> dict:
-    global session
-    variables = {"title": f"{title}"}
-    backoff_factor = 0.3
-    attempt = 1
-    while True:
+class TokenBucket:
+    """
+    Spaces the requests out to stay under the rate limit. The bucket refills at
+    the limit per minute, allowing short bursts, and follows the X-RateLimit
+    headers of the responses, pausing until the reset when none are left.
+    """
+
+    def __init__(self, per_minute: int, burst: int):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    await asyncio.sleep(self.resume_at - now)
+                    continue
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for a while, e.g. after a 429."""
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.resume_at = max(self.resume_at, self.updated + seconds)
+
+    def update(self, headers: httpx.Headers) -> None:
+        if "X-RateLimit-Limit" in headers:
+            self.rate = int(headers["X-RateLimit-Limit"]) / 60
+        # A 429 comes with Retry-After, handled by the caller
+        if headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset" in headers:
+            self.pause(int(headers["X-RateLimit-Reset"]) - time.time())
+
+
+def build_query(size: int) -> str:
+    """A query searching size titles at once, given as the variables t0, t1, ..."""
+    variables = ", ".join(f"$t{i}: String" for i in range(size))
+    fields = "\n".join(
+        f"  t{i}: Media(search: $t{i}, type: MANGA) {{ ...manga }}" for i in range(size)
+    )
+    return f"query ({variables}) {{\n{fields}\n}}\n{MEDIA_FRAGMENT}"
+
+
+async def post_query(
+    client: httpx.AsyncClient,
+    bucket: TokenBucket,
+    url: str,
+    query: str,
+    variables: dict,
+) -> Optional[dict]:
+    """
+    Send a query and return its data. Rate limiting, server errors and network
+    errors are retried, None is returned for other errors or after MAX_ATTEMPTS.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        await bucket.acquire()
         try:
-            response = session.post(
-                ANILIST_URL, json={"query": ANILIST_QUERY, "variables": variables}
+            response = await client.post(
+                url, json={"query": query, "variables": variables}
             )
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            print(f"Request failed for {title}: {e}")
-            if response.status_code == 404:
-                print(f"{title} doesn't exist")
-                return None
-            delay = int(response.headers.get("Retry-After", "60"))
-            print(f"Sleeping {delay}..........")
-            time.sleep(delay)
-            attempt += 1
-            session = requests.Session()
+        except httpx.TransportError as e:
+            delay = backoff(attempt)
+            logging.warning(f"Request failed: {e!r}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        bucket.update(response.headers)
+        if response.status_code == 429:
+            delay = retry_after(response.headers, attempt)
+            logging.warning(f"Rate limited, pausing {delay:.1f}s")
+            bucket.pause(delay)
+            continue
+        if response.status_code >= 500:
+            delay = backoff(attempt)
+            logging.warning(f"Server error {response.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        try:
+            body = response.json()
         except json.JSONDecodeError:
-            print("Failed to decode JSON")
+            logging.error(f"Failed to decode the response ({response.status_code})")
+            return None
+        # A title AniList can't find is null in the data, with a 404 error,
+        # the other titles of the batch are still there. Without data it failed.
+        if response.status_code == 404 and body.get("data") is not None:
+            return body["data"]
+        if response.status_code != 200:
+            logging.error(f"Query failed ({response.status_code}): {body.get('errors')}")
+            return None
+        return body.get("data")
+    logging.error(f"Giving up after {MAX_ATTEMPTS} attempts")
     return None
 
 
-def process_row(row):
-    title = row.clean_title
-    title_uuid = row.title_uuid
-    print(f"Extracting data for {title}")
-    json_r = fetch_json(title)
-    if json_r:
-        manga_data = json_r["data"]["Media"]
-        romaji_title = manga_data["title"]["romaji"]
-        jp_title = manga_data["title"]["native"]
-        year = manga_data["startDate"]["year"]
-        genres = manga_data["genres"]
-        score = manga_data["averageScore"]
-        record = {
-            "title": title,
-            "romanji_title": romaji_title,
-            "jp_title": jp_title,
-            "title_uuid": title_uuid,
-            "start_year": year,
-            "score": score,
-            "genres": genres,
-        }
-        return record
-    else:
-        return None
-
-
-def save_record(record: dict, file_path: str) -> None:
-    with open(file_path, "a") as file:
-        file.write(json.dumps(record) + "\n")
-
-
-open(OUTPUT_DATA, "w").close()
-
-for row in df.itertuples(index=True):
-    result = process_row(row)
-    save_record(result, OUTPUT_DATA)
+def to_record(row, media: dict) -> dict:
+    return {
+        "title": row.clean_title,
+        "romanji_title": media["title"]["romaji"],
+        "jp_title": media["title"]["native"],
+        "english_title": media["title"]["english"],
+        "title_uuid": row.title_uuid,
+        "start_year": media["startDate"]["year"],
+        "score": media["averageScore"],
+        "genres": media["genres"],
+    }
+
+
+def title_key(url: str, title: str) -> str:
+    """
+    Responses are cached per title, as the query searching that title alone,
+    so they're found again whatever batch the title was fetched in.
+    """
+    return cache_key(url, build_query(1), {"t0": title})
+
+
+async def fetch_batch(
+    client: httpx.AsyncClient,
+    bucket: TokenBucket,
+    cache: ResponseCache,
+    url: str,
+    rows: list,
+) -> List[dict]:
+    variables = {f"t{i}": row.clean_title for i, row in enumerate(rows)}
+    data = await post_query(client, bucket, url, build_query(len(rows)), variables)
+    # Only a title that is null in the data doesn't exist, when one isn't there at
+    # all nothing is cached so the batch is fetched again on the next run
+    if data is None or not all(alias in data for alias in variables):
+        logging.error(f"Failed to fetch {', '.join(variables.values())}")
+        return []
+    records = []
+    for i, row in enumerate(rows):
+        media = data.get(f"t{i}")
+        cache.set(title_key(url, row.clean_title), url, media)
+        if media is None:
+            logging.info(f"{row.clean_title} doesn't exist")
+            continue
+        records.append(to_record(row, media))
+    return records
+
+
+async def enrich(
+    rows: list,
+    url: str,
+    batch_size: int,
+    concurrency: int,
+    output_path: str,
+    cache: ResponseCache,
+) -> int:
+    """
+    Append the records of the titles to the output, from the cache when possible.
+    The others are fetched batch by batch and written in input order, each batch
+    as soon as it's done so an interrupted run keeps its progress.
+    """
+    written = 0
+    pending = []
+    with open(output_path, "a") as file:
+        for row in rows:
+            media = cache.get(title_key(url, row.clean_title))
+            if media is None:
+                pending.append(row)
+            elif media is not MISSING:
+                file.write(json.dumps(to_record(row, media)) + "\n")
+                written += 1
+    logging.info(f"{len(rows) - len(pending)} titles cached, fetching {len(pending)}")
+    return written + await fetch_pending(
+        pending, url, batch_size, concurrency, output_path, cache
+    )
+
+
+async def fetch_pending(
+    rows: list,
+    url: str,
+    batch_size: int,
+    concurrency: int,
+    output_path: str,
+    cache: ResponseCache,
+) -> int:
+    bucket = TokenBucket(RATE_LIMIT, BURST)
+    semaphore = asyncio.Semaphore(concurrency)
+    batches = [rows[i : i + batch_size] for i in range(0, len(rows), batch_size)]
+
+    async def run(batch: list) -> List[dict]:
+        async with semaphore:
+            return await fetch_batch(client, bucket, cache, url, batch)
+
+    written = 0
+    async with httpx.AsyncClient(timeout=30) as client:
+        tasks = [asyncio.create_task(run(batch)) for batch in batches]
+        with open(output_path, "a") as file:
+            for done, task in enumerate(tasks, start=1):
+                for record in await task:
+                    file.write(json.dumps(record) + "\n")
+                    written += 1
+                file.flush()
+                logging.info(f"Fetched {done}/{len(batches)} batches")
+    return written
+
+
+def save_parquet(jsonl_path: str, parquet_path: str) -> None:
+    """Convert the records to Parquet, with genres stored as a list column."""
+    records = pd.read_json(jsonl_path, lines=True, dtype=False)
+    if records.empty:
+        logging.warning(f"No records in {jsonl_path}, not writing {parquet_path}")
+        return
+    # Records fetched before english_title was kept don't have it
+    records = records.reindex(columns=[*ANILIST_DTYPES, "genres"]).astype(
+        ANILIST_DTYPES
+    )
+    records["genres"] = records["genres"].apply(
+        lambda genres: list(genres) if isinstance(genres, list) else []
+    )
+    records.to_parquet(parquet_path, index=False)
+
+
+def copy_records(rows: list, output_path: str) -> Tuple[list, int]:
+    """
+    Append a copy of the record of the title builder.py matched each row to, its
+    anilist_uuid, when that title is in the output already. Returns the rows left
+    to fetch and the number of records copied.
+    """
+    # Missing from the input of older builder.py runs, NaN for the unmatched titles
+    anilist_uuids = {getattr(row, "anilist_uuid", None) for row in rows}
+    anilist_uuids = {uuid for uuid in anilist_uuids if isinstance(uuid, str)}
+    if not anilist_uuids or not Path(output_path).exists():
+        return rows, 0
+    records = {}
+    with open(output_path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("title_uuid") in anilist_uuids:
+                records[record["title_uuid"]] = record
+    pending = []
+    copied = 0
+    with open(output_path, "a") as file:
+        for row in rows:
+            record = records.get(getattr(row, "anilist_uuid", None))
+            if record is None:
+                pending.append(row)
+                continue
+            copy = {**record, "title": row.clean_title, "title_uuid": row.title_uuid}
+            file.write(json.dumps(copy) + "\n")
+            copied += 1
+    return pending, copied
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fetch the AniList details of the titles.")
+    parser.add_argument("--input", default=INPUT_PATH, help="CSV of the titles to fetch")
+    parser.add_argument("--url", default=ANILIST_URL, help="GraphQL endpoint")
+    parser.add_argument(
+        "--batch-size", type=int, default=BATCH_SIZE, help="Titles per request"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=CONCURRENCY, help="Requests in flight"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Rewrite the output instead of skipping the titles it already has, "
+        "only titles missing from the cache or expired are fetched",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    rows = list(pd.read_csv(args.input).itertuples(index=False))
+    if args.refresh:
+        open(OUTPUT_DATA, "w").close()
+    done = fetched_titles(OUTPUT_DATA)
+    rows = [row for row in rows if row.title_uuid not in done]
+    # Titles builder.py matched to a title already fetched aren't searched again
+    rows, copied = copy_records(rows, OUTPUT_DATA)
+    logging.info(
+        f"{len(done)} titles already fetched, {copied} copied from a matching title, "
+        f"{len(rows)} to go"
+    )
+    cache = ResponseCache()
+    try:
+        written = asyncio.run(
+            enrich(rows, args.url, args.batch_size, args.concurrency, OUTPUT_DATA, cache)
+        )
+    finally:
+        cache.close()
+    logging.info(f"Found {written} of {len(rows)} titles on AniList")
+    save_parquet(OUTPUT_DATA, OUTPUT_PARQUET)
+    logging.info("Run transform.py --mart-only to update the general view")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,171 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List
+
 import pandas as pd
-import requests
-
-df = pd.read_csv("data/dim_manga.csv")
-json_l = pd.read_json("data/genres.jsonl", lines=True)
-manual_cleaned = pd.read_csv("data/cleaned_titles.tsv", sep="\t")
-manual_cleaned = manual_cleaned.merge(df[["clean_title", "title_uuid"]], how="inner")
-manual_cleaned["clean_title"] = manual_cleaned["alternate_title"].fillna(
-    manual_cleaned["clean_title"]
+
+from title_matcher import (
+    CatalogEntry,
+    TitleMatcher,
+    is_confident,
+    is_own_record,
+    normalize_title,
 )
-json_l["clean_title"] = json_l["romanji_title"]
-pd.concat(
-    [
-        json_l[["clean_title", "title_uuid"]],
-        manual_cleaned[["clean_title", "title_uuid"]],
-    ]
-).to_csv("data/temp.csv", index=False)
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+DIM_MANGA_PATH = "data/dim_manga.csv"
+# Metadata already fetched, the titles the matcher searches
+ANILIST_PATH = "data/anilist_data.jsonl"
+CATALOG_PATHS = ["data/genres.jsonl", ANILIST_PATH]
+MANUAL_PATH = "data/cleaned_titles.tsv"
+OUTPUT_PATH = "data/temp.csv"
+REVIEW_PATH = "data/title_review.csv"
+CANDIDATES = 3
+
+
+def load_catalog(paths: List[str]) -> List[CatalogEntry]:
+    """
+    One entry per metadata title, records of the same title coming from several
+    sources or searches are merged.
+    """
+    titles: Dict[str, set] = {}
+    labels: Dict[str, str] = {}
+    for path in paths:
+        if not Path(path).exists():
+            continue
+        with open(path) as file:
+            for line in file:
+                record = json.loads(line)
+                romaji = record.get("romanji_title") or ""
+                key = normalize_title(romaji)
+                if not key:
+                    continue
+                labels.setdefault(key, romaji)
+                titles.setdefault(key, set()).update(
+                    title
+                    for title in (
+                        romaji,
+                        record.get("english_title"),
+                        record.get("jp_title"),
+                    )
+                    if title
+                )
+    return [CatalogEntry(key, labels[key], tuple(titles[key])) for key in labels]
+
+
+def load_own_records(paths: List[str]) -> Dict[str, CatalogEntry]:
+    """
+    The metadata record fetched for each title_uuid, a title is matched to its own
+    record before any other. The later paths take precedence.
+    """
+    own_records = {}
+    for path in paths:
+        if not Path(path).exists():
+            continue
+        with open(path) as file:
+            for line in file:
+                record = json.loads(line)
+                romaji = record.get("romanji_title") or ""
+                if not romaji or not record.get("title_uuid"):
+                    continue
+                titles = (romaji, record.get("english_title"), record.get("jp_title"))
+                own_records[record["title_uuid"]] = CatalogEntry(
+                    normalize_title(romaji),
+                    romaji,
+                    tuple(title for title in titles if title),
+                )
+    return own_records
+
+
+def load_anilist_uuids(path: str) -> Dict[str, str]:
+    """
+    The title_uuid of the AniList record of each catalog entry, by key. A title
+    resolved to one of them reuses that record, anilist.py doesn't search it.
+    """
+    anilist_uuids = {}
+    if not Path(path).exists():
+        return anilist_uuids
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            key = normalize_title(record.get("romanji_title") or "")
+            if key and record.get("title_uuid"):
+                anilist_uuids.setdefault(key, record["title_uuid"])
+    return anilist_uuids
+
+
+def load_manual_titles() -> pd.DataFrame:
+    """The search titles picked by hand, for the titles the matcher can't resolve."""
+    if not Path(MANUAL_PATH).exists():
+        return pd.DataFrame(columns=["clean_title", "title_uuid"])
+    df = pd.read_csv(DIM_MANGA_PATH)
+    manual_cleaned = pd.read_csv(MANUAL_PATH, sep="\t")
+    manual_cleaned = manual_cleaned.merge(df[["clean_title", "title_uuid"]], how="inner")
+    manual_cleaned["clean_title"] = manual_cleaned["alternate_title"].fillna(
+        manual_cleaned["clean_title"]
+    )
+    return manual_cleaned[["clean_title", "title_uuid"]]
+
+
+def main() -> None:
+    df = pd.read_csv(DIM_MANGA_PATH)
+    catalog = load_catalog(CATALOG_PATHS)
+    own_records = load_own_records(CATALOG_PATHS)
+    anilist_uuids = load_anilist_uuids(ANILIST_PATH)
+    matcher = TitleMatcher(catalog)
+    logging.info(f"Matching {len(df)} titles against {len(catalog)} catalog titles")
+    matches = matcher.match_all(df["clean_title"].tolist(), top_k=CANDIDATES)
+
+    resolved = []
+    review = []
+    for row, candidates in zip(df.itertuples(index=False), matches):
+        own_record = own_records.get(row.title_uuid)
+        if own_record is not None and is_own_record(row.clean_title, own_record):
+            resolved.append(
+                {
+                    "clean_title": own_record.label,
+                    "title_uuid": row.title_uuid,
+                    "anilist_uuid": anilist_uuids.get(own_record.key),
+                }
+            )
+            continue
+        if is_confident(row.clean_title, candidates):
+            resolved.append(
+                {
+                    "clean_title": candidates[0].label,
+                    "title_uuid": row.title_uuid,
+                    "anilist_uuid": anilist_uuids.get(candidates[0].key),
+                }
+            )
+            continue
+        review_row = {"clean_title": row.clean_title, "title_uuid": row.title_uuid}
+        for rank, candidate in enumerate(candidates, start=1):
+            review_row[f"candidate_{rank}"] = candidate.label
+            review_row[f"score_{rank}"] = round(candidate.score, 3)
+        review.append(review_row)
+    resolved = pd.DataFrame(
+        resolved, columns=["clean_title", "title_uuid", "anilist_uuid"]
+    )
+    review = pd.DataFrame(review)
+    review.to_csv(REVIEW_PATH, index=False)
+    logging.info(
+        f"Resolved {len(resolved)} titles, {len(review)} left for review in {REVIEW_PATH}"
+    )
+
+    # Titles resolved by hand take precedence, the others are searched as they are
+    manual = load_manual_titles()
+    unresolved = df[~df["title_uuid"].isin(resolved["title_uuid"])]
+    unresolved = unresolved[~unresolved["title_uuid"].isin(manual["title_uuid"])]
+    pd.concat(
+        [
+            resolved[~resolved["title_uuid"].isin(manual["title_uuid"])],
+            manual,
+            unresolved[["clean_title", "title_uuid"]],
+        ]
+    ).to_csv(OUTPUT_PATH, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+CACHE_PATH = Path(".cache/http_cache.db")
+# Responses older than this are fetched again
+DEFAULT_TTL = 30 * 24 * 3600
+# Least recently used responses are evicted past this size
+MAX_BYTES = 256 * 1024 * 1024
+
+# Marks a cached response that was empty, e.g. a title AniList doesn't have
+MISSING = object()
+
+
+def normalize_query(query: str) -> str:
+    """Collapse the whitespace of a GraphQL query, indentation doesn't change it."""
+    return " ".join(query.split())
+
+
+def cache_key(url: str, query: Optional[str] = None, variables: Optional[dict] = None) -> str:
+    """
+    The key of a request: its URL, normalized query and variables, the variables
+    serialized with sorted keys so their order doesn't matter.
+    """
+    parts = [
+        url,
+        normalize_query(query) if query else "",
+        json.dumps(variables or {}, sort_keys=True, ensure_ascii=False),
+    ]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of the JSON responses of the enrichment scripts, shared by
+    anilist.py and kitsu.py. Safe to use from several threads.
+    """
+
+    def __init__(
+        self, path: Path = CACHE_PATH, ttl: int = DEFAULT_TTL, max_bytes: int = MAX_BYTES
+    ):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                body TEXT,
+                size INTEGER,
+                created_at REAL,
+                accessed_at REAL
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)"
+        )
+        self.conn.commit()
+
+    def get(self, key: str):
+        """
+        The cached response, None when it isn't cached or expired, MISSING when
+        the response was empty.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body FROM responses WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.conn.commit()
+        body = json.loads(row[0])
+        return MISSING if body is None else body
+
+    def set(self, key: str, url: str, body) -> None:
+        """Store a response, None for an empty one."""
+        text = json.dumps(body, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, url, body, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, url, text, len(text.encode()), now, now),
+            )
+            self.conn.commit()
+
+    def evict(self) -> None:
+        """Drop the expired responses, then the least recently used over max_bytes."""
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                "DELETE FROM responses WHERE created_at <= ?", (time.time() - self.ttl,)
+            )
+            expired = cur.rowcount
+            # Keep the most recently used responses that fit in max_bytes
+            cur.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, sum(size) OVER (ORDER BY accessed_at DESC, key) AS total
+                        FROM responses
+                    ) WHERE total > ?
+                )
+                """,
+                (self.max_bytes,),
+            )
+            evicted = cur.rowcount
+            self.conn.commit()
+        if expired or evicted:
+            logging.info(f"Dropped {expired} expired and {evicted} cached responses")
+
+    def close(self) -> None:
+        self.evict()
+        self.conn.close()
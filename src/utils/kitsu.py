@@ -1,91 +1,205 @@
-from concurrent.futures import ThreadPoolExecutor
-import requests
-import pandas as pd
+import argparse
+import asyncio
 import json
+import logging
+import time
+from typing import Optional
+
+import httpx
+import pandas as pd
+
+from http_cache import ResponseCache, cache_key
+from records import fetched_titles
+from retry import MAX_ATTEMPTS, backoff, retry_after
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
-BASE_URL = "https://kitsu.app/api/edge/manga?filter[text]="
+BASE_URL = "https://kitsu.app/api/edge/manga"
 OUTPUT_PATH = "data/genres.jsonl"
 CSV_PATH = "data/dim_manga.csv"
-session = requests.Session()
+# Requests in flight start at INITIAL_CONCURRENCY and adapt between these bounds
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+# Records are flushed to the output every FLUSH_EVERY records
+FLUSH_EVERY = 50
 
-df = pd.read_csv(CSV_PATH)
 
+class AdaptiveLimiter:
+    """
+    Bounds the requests in flight with additive increase, multiplicative decrease.
+    Every success raises the limit by 1/limit, so about one more request per round
+    trip, a 429 or a server error halves it. Errors coming back from requests sent
+    before the last decrease don't decrease it again.
+    """
 
-def fetch_json(url: str) -> dict:
-    try:
-        response = session.get(url)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        print(f"Request failed for {url}: {e}")
-    except json.JSONDecodeError:
-        print("Failed to decode JSON")
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> float:
+        """Wait for a slot, returns the time the request is sent at."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, sent_at: float, overloaded: bool) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            if not overloaded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif sent_at > self.decreased_at:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.decreased_at = time.monotonic()
+                logging.info(f"Backing off to {int(self.limit)} requests in flight")
+            self.condition.notify_all()
+
+
+async def get_json(
+    client: httpx.AsyncClient, limiter: AdaptiveLimiter, url: str, params: dict
+) -> Optional[dict]:
+    """
+    GET a JSON:API document. 429s, server errors and network errors are retried,
+    None is returned for other errors or after MAX_ATTEMPTS.
+    """
+    title = params["filter[text]"]
+    for attempt in range(MAX_ATTEMPTS):
+        sent_at = await limiter.acquire()
+        overloaded = True
+        try:
+            response = await client.get(url, params=params)
+            overloaded = response.status_code == 429 or response.status_code >= 500
+        except httpx.TransportError as e:
+            logging.warning(f"Request failed for {title}: {e!r}")
+            await asyncio.sleep(backoff(attempt))
+            continue
+        finally:
+            await limiter.release(sent_at, overloaded)
+        if overloaded:
+            delay = retry_after(response.headers, attempt)
+            logging.warning(f"Kitsu answered {response.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        try:
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPStatusError as e:
+            logging.error(f"Request failed for {title}: {e}")
+        except json.JSONDecodeError:
+            logging.error(f"Failed to decode the response for {title}")
+        return None
+    logging.error(f"Giving up on {title} after {MAX_ATTEMPTS} attempts")
     return None
 
 
-def extract_data(url: str):
-    json_dict = fetch_json(url)
-    if not json_dict or "data" not in json_dict:
-        return []
+def related(document: dict, manga: dict, name: str, attribute: str) -> list:
+    """An attribute of the resources of a relationship, taken from the included ones."""
+    included = {
+        (item["type"], item["id"]): item for item in document.get("included", [])
+    }
+    references = manga["relationships"].get(name, {}).get("data") or []
     return [
-        (
-            item["attributes"].get("title")
-            if item["type"] == "categories"
-            else item["attributes"].get("name")
-        )
-        for item in json_dict["data"]
+        included[(reference["type"], reference["id"])]["attributes"].get(attribute)
+        for reference in references
+        if (reference["type"], reference["id"]) in included
     ]
 
 
-def save_data(json_dict: dict) -> None:
-    with open("data/genres.json", "w") as file:
-        file.write(json.dumps(json_dict))
+def to_record(row, document: dict) -> Optional[dict]:
+    if not document.get("data"):
+        logging.info(f"No data found for {row.clean_title}")
+        return None
+    # we pick the first one
+    manga = document["data"][0]
+    return {
+        "title": row.clean_title,
+        "romanji_title": manga["attributes"]["titles"].get("en_jp", ""),
+        "jp_title": manga["attributes"]["titles"].get("ja_jp", ""),
+        "english_title": manga["attributes"]["titles"].get("en", ""),
+        "title_uuid": row.title_uuid,
+        "start_date": manga["attributes"]["startDate"],
+        "categories": related(document, manga, "categories", "title"),
+        "genres": related(document, manga, "genres", "name"),
+    }
 
 
-def save_record(record: dict, file_path: str) -> None:
-    with open(file_path, "a") as file:
-        file.write(json.dumps(record) + "\n")
+async def fetch_title(
+    client: httpx.AsyncClient,
+    limiter: AdaptiveLimiter,
+    cache: ResponseCache,
+    url: str,
+    row,
+) -> Optional[dict]:
+    """
+    Search a title, its genres and categories are included in the same response
+    instead of being fetched from the relationship links.
+    """
+    params = {
+        "filter[text]": row.clean_title,
+        "include": "genres,categories",
+        "page[limit]": 1,
+    }
+    key = cache_key(url, variables=params)
+    document = cache.get(key)
+    if document is None:
+        document = await get_json(client, limiter, url, params)
+        if document is None:
+            return None
+        cache.set(key, url, document)
+    return to_record(row, document)
 
 
-def process_row(row):
-    title = row.clean_title
-    title_uuid = row.title_uuid
-    search_url = f"{BASE_URL}{title}"
-    print(f"Searching {title}")
-    json_r = fetch_json(search_url)
-    if len(json_r["data"]) > 0:
-        print(f"Extracting data for {title}")
-        # we pick the first one
-        manga_data = json_r["data"][0]
-        start_date = manga_data["attributes"]["startDate"]
-        romaji_title = manga_data["attributes"]["titles"].get("en_jp", "")
-        jp_title = manga_data["attributes"]["titles"].get("ja_jp", "")
-        relationship_genre_link = manga_data["relationships"]["genres"]["links"][
-            "related"
+async def enrich(rows: list, url: str, output_path: str, cache: ResponseCache) -> int:
+    """
+    Fetch the titles concurrently. This coroutine is the only writer of the output,
+    it appends the records as they come and flushes them every FLUSH_EVERY records.
+    """
+    limiter = AdaptiveLimiter(INITIAL_CONCURRENCY, MIN_CONCURRENCY, MAX_CONCURRENCY)
+    written = 0
+    async with httpx.AsyncClient(timeout=30) as client:
+        tasks = [
+            asyncio.create_task(fetch_title(client, limiter, cache, url, row))
+            for row in rows
         ]
-        category_genre_link = manga_data["relationships"]["categories"]["links"][
-            "related"
-        ]
-        genres = extract_data(relationship_genre_link)
-        categories = extract_data(category_genre_link)
-        record = {
-            "title": title,
-            "romanji_title": romaji_title,
-            "jp_title": jp_title,
-            "title_uuid": title_uuid,
-            "start_date": start_date,
-            "categories": categories,
-            "genres": genres,
-        }
-        return record
-    else:
-        print(f"No data found for {title}")
-    return None
+        with open(output_path, "a") as file:
+            for task in asyncio.as_completed(tasks):
+                record = await task
+                if record is None:
+                    continue
+                file.write(json.dumps(record) + "\n")
+                written += 1
+                if written % FLUSH_EVERY == 0:
+                    file.flush()
+                    logging.info(f"Fetched {written} titles")
+    return written
 
 
-with ThreadPoolExecutor(max_workers=10) as executor:
-    results = executor.map(process_row, df.itertuples(index=False))
-    for record in results:
-        if record:
-            with open(OUTPUT_PATH, "a") as file:
-                file.write(json.dumps(record) + "\n")
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fetch the Kitsu genres of the titles.")
+    parser.add_argument("--input", default=CSV_PATH, help="CSV of the titles to fetch")
+    parser.add_argument("--url", default=BASE_URL, help="Kitsu manga endpoint")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    df = pd.read_csv(args.input)
+    # Titles already in the output are skipped, so an interrupted run resumes
+    done = fetched_titles(OUTPUT_PATH)
+    rows = [row for row in df.itertuples(index=False) if row.title_uuid not in done]
+    logging.info(f"{len(done)} titles already fetched, {len(rows)} to go")
+    cache = ResponseCache()
+    try:
+        written = asyncio.run(enrich(rows, args.url, OUTPUT_PATH, cache))
+    finally:
+        cache.close()
+    logging.info(f"Found {written} of {len(rows)} titles on Kitsu")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import json
+from pathlib import Path
+from typing import Set
+
+
+def fetched_titles(path: str) -> Set[str]:
+    """
+    The title_uuids already written to the JSON Lines output of an enrichment
+    script, which skips them to resume an interrupted run. A line cut short by
+    a crash is ignored.
+    """
+    if not Path(path).exists():
+        return set()
+    done = set()
+    with open(path) as file:
+        for line in file:
+            try:
+                done.add(json.loads(line)["title_uuid"])
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue
+    return done
@@ -0,0 +1,33 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping
+
+# Requests are retried up to MAX_ATTEMPTS times, waiting longer after each attempt
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+
+def backoff(attempt: int) -> float:
+    """Capped exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+def retry_after(headers: Mapping[str, str], attempt: int) -> float:
+    """
+    The seconds to wait before retrying, from the Retry-After header, given either
+    as seconds or as an HTTP date. Falls back to the backoff when it's missing or
+    can't be parsed.
+    """
+    value = headers.get("Retry-After")
+    if value is None:
+        return backoff(attempt)
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return backoff(attempt)
@@ -0,0 +1,167 @@
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+from typing import Dict, List, Sequence, Tuple
+
+NGRAM = 3
+# Candidates reranked with the edit-distance ratio after the n-gram search
+RERANK = 10
+# A match is resolved locally when its score and its lead over the runner-up
+# are at least these, otherwise it's left for manual review
+ACCEPT_SCORE = 0.75
+MIN_MARGIN = 0.05
+
+# ei isn't folded, it's as often two vowels (e.g. Reiwa, Eiga) as a long e
+LONG_VOWELS = [("ou", "o"), ("oo", "o"), ("uu", "u"), ("aa", "a")]
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    """A metadata record and the titles it's known by: romaji, English, native."""
+
+    key: str
+    label: str
+    titles: Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class Candidate:
+    """An entry matching a query, matched is its normalized title that scored."""
+
+    key: str
+    label: str
+    score: float
+    matched: str
+
+
+def normalize_title(title: str) -> str:
+    """
+    Fold the differences that don't make two titles different: width, case,
+    accents and macrons, punctuation, the (Upscaled) of the uploads and the
+    spellings of romaji long vowels, e.g. Shounen and Shōnen both become shonen.
+    """
+    title = unicodedata.normalize("NFKC", title).replace("(Upscaled)", "").casefold()
+    title = "".join(
+        char
+        for char in unicodedata.normalize("NFKD", title)
+        if not unicodedata.combining(char)
+    )
+    title = re.sub(r"[\W_]+", " ", title).strip()
+    for long_vowel, vowel in LONG_VOWELS:
+        title = title.replace(long_vowel, vowel)
+    return title
+
+
+def ngrams(title: str) -> Counter:
+    """The character n-grams of a normalized title, padded so word edges count."""
+    padded = f" {title} "
+    if len(padded) <= NGRAM:
+        return Counter([padded])
+    return Counter(padded[i : i + NGRAM] for i in range(len(padded) - NGRAM + 1))
+
+
+class TitleMatcher:
+    """
+    Index of the titles of a catalog by character n-grams, weighted by TF-IDF.
+    A query is scored against every title sharing an n-gram with it by cosine
+    similarity, the best few are reranked by edit distance.
+    """
+
+    def __init__(self, entries: Sequence[CatalogEntry]):
+        self.entries = list(entries)
+        # Every title of every entry, normalized, with the entry it belongs to
+        self.titles: List[Tuple[int, str]] = []
+        for index, entry in enumerate(self.entries):
+            for title in {normalize_title(title) for title in entry.titles if title}:
+                if title:
+                    self.titles.append((index, title))
+        grams = [ngrams(title) for _, title in self.titles]
+        document_frequency = Counter(gram for counts in grams for gram in counts)
+        self.idf = {
+            gram: math.log(1 + len(self.titles) / frequency)
+            for gram, frequency in document_frequency.items()
+        }
+        self.postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        self.norms = []
+        for title_index, counts in enumerate(grams):
+            weights = {gram: count * self.idf[gram] for gram, count in counts.items()}
+            self.norms.append(math.sqrt(sum(w * w for w in weights.values())))
+            for gram, weight in weights.items():
+                self.postings[gram].append((title_index, weight))
+
+    def candidates(self, query: str, top_k: int = 3) -> List[Candidate]:
+        """The best entries for a title, best first, at most one per entry."""
+        query = normalize_title(query)
+        if not query:
+            return []
+        # n-grams the catalog doesn't have still count in the norm of the query
+        unseen_idf = math.log(1 + len(self.titles))
+        weights = {
+            gram: count * self.idf.get(gram, unseen_idf)
+            for gram, count in ngrams(query).items()
+        }
+        query_norm = math.sqrt(sum(w * w for w in weights.values()))
+        dot_products = defaultdict(float)
+        for gram, weight in weights.items():
+            for title_index, title_weight in self.postings.get(gram, ()):
+                dot_products[title_index] += weight * title_weight
+        best = {}
+        for title_index, dot_product in dot_products.items():
+            cosine = dot_product / (query_norm * self.norms[title_index])
+            entry_index, _ = self.titles[title_index]
+            if cosine > best.get(entry_index, (0.0, None))[0]:
+                best[entry_index] = (cosine, title_index)
+        shortlist = sorted(best.items(), key=lambda item: -item[1][0])[:RERANK]
+        candidates = []
+        for entry_index, (cosine, title_index) in shortlist:
+            matched = self.titles[title_index][1]
+            ratio = SequenceMatcher(None, query, matched).ratio()
+            entry = self.entries[entry_index]
+            candidates.append(
+                Candidate(entry.key, entry.label, (cosine + ratio) / 2, matched)
+            )
+        candidates.sort(key=lambda candidate: -candidate.score)
+        return candidates[:top_k]
+
+    def match_all(
+        self, queries: Sequence[str], top_k: int = 3
+    ) -> List[List[Candidate]]:
+        return [self.candidates(query, top_k) for query in queries]
+
+
+def same_markers(query: str, title: str) -> bool:
+    """
+    Whether two normalized titles have the same numbers and end with the same word,
+    which tell apart the entries of a series, e.g. Gundam 00I and Gundam 00F or
+    Kekkai Sensen and Kekkai Senso, however close the rest of the title is. Words
+    may be split differently, Casinogui ends like Casino Gui.
+    """
+    if re.findall(r"\d+", query) != re.findall(r"\d+", title):
+        return False
+    query_words, title_words = query.split(), title.split()
+    if not query_words or not title_words:
+        return query_words == title_words
+    return title.replace(" ", "").endswith(query_words[-1]) or query.replace(
+        " ", ""
+    ).endswith(title_words[-1])
+
+
+def is_confident(query: str, candidates: Sequence[Candidate]) -> bool:
+    """Whether the best candidate for a title can be taken without a manual review."""
+    if not candidates or candidates[0].score < ACCEPT_SCORE:
+        return False
+    if not same_markers(normalize_title(query), candidates[0].matched):
+        return False
+    return len(candidates) == 1 or candidates[0].score - candidates[1].score >= MIN_MARGIN
+
+
+def is_own_record(query: str, entry: CatalogEntry) -> bool:
+    """
+    Whether the record fetched for a title can be taken, the search it comes from
+    may have found another entry of the series.
+    """
+    query = normalize_title(query)
+    return any(same_markers(query, normalize_title(title)) for title in entry.titles)